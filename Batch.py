@@ -0,0 +1,387 @@
+import pandas as pd
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+from Uploads import RejectLog, table_name, file_digest, preflight_upload, validate_upload, to_columnar, read_columnar, \
+    read_upload
+from Database import get_backend, connect_to_db, check_workspace, get_schema, get_store_dir, run_query, \
+    quote_identifier, bulk_load, build_derived_tables
+from Workspaces import create_workspace, touch_workspace, start_load, record_file_loaded, finish_load, \
+    get_loaded_workspaces
+from StageCache import purge_results
+from Matches import MATCH_COLUMNS, identify_new_matches, export_matches
+
+# Exit codes, so that a scheduler can tell what went wrong
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_LOAD_FAILED = 3
+EXIT_MATCHES_FAILED = 4
+EXIT_PROCESSING_FAILED = 5
+
+# Tables Processing.py reads, besides the Country Mapping shipped with the app
+REQUIRED_TABLES = [
+    'Live_Alumni', 'Custom_Fields', 'Phone_List', 'Org_Relationships', 'Org_Relationship_Attributes', 'Addresses'
+]
+
+# Stages that can be left out of a run
+OPTIONAL_STAGES = ['Organisations', 'LinkedIn', 'Emails', 'Addresses']
+
+# Name of the file users download from the web app, so that both can be imported the same way
+ZIP_NAME = 'Live_Alumni_Data_to_upload_in_Raisers_Edge.zip'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Load a directory of Live Alumni and RE exports, identify new matches and build the RE import '
+                    'files, without the web app.'
+    )
+
+    parser.add_argument('exports_dir', help='directory holding the exported CSV files, named as on the upload page')
+    parser.add_argument('--output', default=ZIP_NAME, help=f'ZIP file of the RE import files (default: {ZIP_NAME})')
+    parser.add_argument('--metrics', help='JSON report of the run (default: next to the ZIP file)')
+    parser.add_argument('--stages', default=','.join(OPTIONAL_STAGES),
+                        help=f"comma-separated stages to run (default: {','.join(OPTIONAL_STAGES)})")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='number of files loaded at the same time (default: number of CPUs)')
+    parser.add_argument('--workspace', default='batch',
+                        help='workspace reused from one run to the next, keeping its import IDs (default: batch)')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='process every alumni, not only the ones changed since the last run')
+    parser.add_argument('--sample', type=int, default=0,
+                        help='process only this many alumni, always the same ones, to check the output quickly')
+    parser.add_argument('--purge-cache', action='store_true',
+                        help='remove the saved stage results first, so that every stage is recomputed')
+    parser.add_argument('--profile-sql', action='store_true', help='record every SQL query in SQL Profile.json')
+    parser.add_argument('--profile-cpu', action='store_true',
+                        help='sample where the time goes, in CPU Profile.folded and CPU Profile.json')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='measure the peak memory of each stage, in the run report')
+    parser.add_argument('--skip-load', action='store_true', help='process the data already loaded in the workspace')
+    parser.add_argument('--skip-matches', action='store_true', help="don't identify new Live Alumni matches")
+
+    args = parser.parse_args(argv)
+
+    args.stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+
+    unknown = set(args.stages) - set(OPTIONAL_STAGES)
+
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    if args.sample < 0:
+        parser.error('--sample must be at least 0')
+
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+
+    try:
+        check_workspace(args.workspace)
+
+    except ValueError as e:
+        parser.error(str(e))
+
+    return args
+
+
+########################################################################################################################
+#                                                      Loading                                                         #
+########################################################################################################################
+
+# Exported files of the directory, by table
+def find_exports(exports_dir):
+    return {
+        table_name(file_name): os.path.join(exports_dir, file_name) for file_name in sorted(os.listdir(exports_dir))
+        if file_name.lower().endswith('.csv') and file_name != 'Matches.csv'
+    }
+
+
+def load_file(path, workspace, rejects):
+    file_name = os.path.basename(path)
+    digest = file_digest(path)
+
+    rows = validate_upload(path, file_name)
+
+    if get_backend() == 'duckdb':
+        to_columnar(path, file_name=file_name, store_dir=get_store_dir(workspace), digest=digest, rejects=rejects)
+
+    else:
+        bulk_load(connect_to_db(workspace), path, file_name, table_name(file_name), get_schema(workspace), rejects)
+
+    record_file_loaded(workspace, file_name, digest, rows, rejects.rejected_rows(file_name))
+
+    print(f'Loaded {file_name}')
+
+
+# Check the header and first rows of every export, so that a wrong file fails the run before anything is loaded
+def preflight_exports(exports_dir, exports):
+    checks = [preflight_upload(path) for path in exports.values()]
+
+    manual_file = os.path.join(exports_dir, 'Matches.csv')
+
+    if os.path.exists(manual_file):
+        checks.append(preflight_upload(manual_file))
+
+    return checks
+
+
+# Load the exports into the workspace, several files at a time
+def load_exports(exports, workspace, workers):
+    rejects = RejectLog()
+
+    start_load(workspace)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='load') as executor:
+        # Consuming the results raises the first error of any file
+        list(executor.map(lambda path: load_file(path, workspace, rejects), exports.values()))
+
+    client = connect_to_db(workspace)
+
+    if get_backend() == 'postgres':
+        pd.read_csv('Files/Country Mapping.csv').to_sql(
+            name='Country_Mapping',
+            con=client,
+            schema=get_schema(workspace),
+            if_exists='replace',
+            index=False
+        )
+
+    build_derived_tables(client, get_store_dir(workspace))
+    finish_load(workspace)
+
+    return rejects
+
+
+########################################################################################################################
+#                                                      Matches                                                         #
+########################################################################################################################
+
+def read_match_table(file_name, workspace):
+    table = table_name(file_name)
+    columns = MATCH_COLUMNS[file_name]
+
+    if get_backend() == 'duckdb':
+        return read_columnar(table, columns=columns, store_dir=get_store_dir(workspace))
+
+    return run_query(
+        connect_to_db(workspace),
+        f"SELECT {', '.join(quote_identifier(col) for col in columns)} FROM {quote_identifier(table)};"
+    )
+
+
+def find_new_matches(exports_dir, workspace, output_dir):
+    manual_file = os.path.join(exports_dir, 'Matches.csv')
+    manual = read_upload(manual_file) if os.path.exists(manual_file) else pd.DataFrame()
+
+    new_matches_data = identify_new_matches(
+        read_match_table('Live Alumni.csv', workspace),
+        read_match_table('Custom Fields.csv', workspace),
+        read_match_table('Phone List.csv', workspace),
+        manual
+    )
+
+    export_matches(new_matches_data, os.path.join(output_dir, 'New Live Alumni Matches.csv'))
+
+    return new_matches_data.shape[0]
+
+
+########################################################################################################################
+#                                                    Processing                                                        #
+########################################################################################################################
+
+# Processing.py runs on its own, as it does for the jobs of the web app, and prints its progress as it goes
+def run_processing(args, workspace, output_dir):
+    env = os.environ.copy()
+    env.update({'WORKSPACE': workspace, 'OUTPUT_DIR': output_dir, 'STAGES': ','.join(args.stages)})
+
+    if args.full_refresh:
+        env['FULL_REFRESH'] = 'true'
+
+    if args.profile_sql:
+        env['PROFILE_SQL'] = 'true'
+
+    if args.profile_cpu:
+        env['PROFILE_CPU'] = 'true'
+
+    if args.profile_memory:
+        env['PROFILE_MEMORY'] = 'true'
+
+    if args.sample:
+        env['SAMPLE_SIZE'] = str(args.sample)
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Processing.py')
+
+    return subprocess.run([sys.executable, '-u', script], env=env).returncode
+
+
+def zip_outputs(output_dir, zip_file):
+    with zipfile.ZipFile(zip_file, 'w') as zip_files:
+        for filename in sorted(os.listdir(output_dir)):
+            if filename.endswith('.csv'):
+                zip_files.write(os.path.join(output_dir, filename), arcname=os.path.join('Final', filename))
+
+
+def export_report(report, output_dir, metrics_file):
+    run_metrics_file = os.path.join(output_dir, 'Run Metrics.json')
+
+    # Stage metrics of Processing.py, when it got far enough to write them
+    if os.path.exists(run_metrics_file):
+        with open(run_metrics_file) as f:
+            report['stages'] = json.load(f)['stages']
+
+    with open(metrics_file, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+
+
+########################################################################################################################
+#                                                       Main                                                           #
+########################################################################################################################
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    output_dir = os.path.splitext(os.path.abspath(args.output))[0]
+    metrics_file = args.metrics or f'{output_dir} Metrics.json'
+
+    report = {
+        'started_at': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'backend': get_backend(),
+        'workspace': args.workspace,
+        'stages_selected': args.stages,
+        'steps': {}
+    }
+
+    def finish(status):
+        report['status'] = status
+        report['finished_at'] = pd.Timestamp.now().isoformat(timespec='seconds')
+        export_report(report, output_dir, metrics_file)
+        print(f'Run report written to {metrics_file}')
+
+        return status
+
+    if not os.path.isdir(args.exports_dir):
+        print(f'{args.exports_dir} is not a directory')
+        return EXIT_USAGE
+
+    exports = find_exports(args.exports_dir)
+
+    missing = [table for table in REQUIRED_TABLES if table not in exports]
+
+    if missing and not args.skip_load:
+        print(f"The following files are missing: {', '.join(table.replace('_', ' ') + '.csv' for table in missing)}")
+        return EXIT_USAGE
+
+    if not args.skip_load:
+        try:
+            report['files'] = preflight_exports(args.exports_dir, exports)
+
+        except ValueError as e:
+            print(e)
+            return EXIT_USAGE
+
+        print(pd.DataFrame(report['files']).to_string(index=False), end='\n\n')
+
+    elif args.workspace not in set(get_loaded_workspaces()['workspace_id']):
+        print(f'Nothing was loaded into workspace {args.workspace} yet, or its last load failed')
+        return EXIT_USAGE
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Files of an earlier run must not end up in this one's ZIP
+    for filename in os.listdir(output_dir):
+        if filename.endswith('.csv'):
+            os.remove(os.path.join(output_dir, filename))
+
+    if args.purge_cache:
+        purge_results()
+        print('Saved stage results removed\n')
+
+    workspace = create_workspace(args.workspace)
+
+    ################################################################################################################
+    #                                                  1. Load                                                     #
+    ################################################################################################################
+
+    if not args.skip_load:
+        print(f'Loading {len(exports)} files into workspace {workspace}...\n')
+        start = time.perf_counter()
+
+        try:
+            rejects = load_exports(exports, workspace, args.workers)
+
+        except Exception as e:
+            print(f'Loading failed: {e}')
+            return finish(EXIT_LOAD_FAILED)
+
+        report['steps']['load'] = {'wall_time_s': round(time.perf_counter() - start, 3), 'files': len(exports)}
+
+        summary = rejects.summary()
+
+        if not summary.empty:
+            print('\nSome values could not be read. Rejected rows are not loaded, other values are left empty.')
+            print(summary.to_string(index=False))
+
+            # Kept out of the output directory, whose CSV files all go to RE
+            rejects.report().to_csv(f'{output_dir} Rejected Values.csv', index=False)
+            report['rejects'] = summary.to_dict(orient='records')
+
+    ################################################################################################################
+    #                                               2. New Matches                                                 #
+    ################################################################################################################
+
+    # Batch runs aren't jobs, so the web app only knows the workspace is in use from the time it was last used. It is
+    # touched between every step, as each of them may take a while.
+    touch_workspace(workspace)
+
+    if not args.skip_matches:
+        print('\nIdentifying new Live Alumni matches...\n')
+        start = time.perf_counter()
+
+        try:
+            new_matches = find_new_matches(args.exports_dir, workspace, output_dir)
+
+        except Exception as e:
+            print(f'Identifying new matches failed: {e}')
+            return finish(EXIT_MATCHES_FAILED)
+
+        report['steps']['matches'] = {'wall_time_s': round(time.perf_counter() - start, 3), 'rows_out': new_matches}
+
+        print(f'{new_matches} new matches found')
+
+    ################################################################################################################
+    #                                                3. Processing                                                 #
+    ################################################################################################################
+
+    touch_workspace(workspace)
+
+    print('\nProcessing...\n')
+    start = time.perf_counter()
+
+    return_code = run_processing(args, workspace, output_dir)
+
+    touch_workspace(workspace)
+
+    report['steps']['processing'] = {'wall_time_s': round(time.perf_counter() - start, 3), 'return_code': return_code}
+
+    if return_code != 0:
+        return finish(EXIT_PROCESSING_FAILED)
+
+    zip_outputs(output_dir, args.output)
+    print(f'\nRE import files written to {args.output}')
+
+    return finish(EXIT_OK)
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+
+    except Exception as e:
+        print(e)
+        sys.exit(EXIT_FAILED)
@@ -0,0 +1,369 @@
+import pandas as pd
+import pyarrow as pa
+import duckdb
+import os
+import re
+
+from io import BytesIO
+from pyarrow import csv as pa_csv
+from sqlalchemy import create_engine, inspect, text
+from urllib.parse import quote_plus
+from Uploads import SCHEMA_VERSION, STORE_DIR, KEY_COLUMNS, RejectLog, read_manifest, write_manifest, \
+    read_projected_batches, typed_schema, shadow_column, import_id_columns, extra_columns, sidecar_table, sidecar_schema
+
+# Workspace names end up in schema names and paths, so they are kept to what both take as is, within the 63 characters
+# of a Postgres name
+WORKSPACE_NAME = re.compile(r'[a-z0-9_]{1,60}')
+
+
+# Load Environment variables
+def get_env_variables():
+    return {
+        'DB_IP': os.getenv('DB_IP'),
+        'DB_USER': os.getenv('DB_USER'),
+        'DB_PASS': quote_plus(os.getenv('DB_PASS', '')),
+        'DB_NAME': os.getenv('DB_NAME')
+    }
+
+
+# Either 'postgres' (default) or 'duckdb', which runs the same queries in-process over the columnar store
+def get_backend():
+    backend = os.getenv('DB_BACKEND', 'postgres').strip().lower()
+
+    if backend not in ('postgres', 'duckdb'):
+        raise ValueError(f'Unknown DB_BACKEND: {backend}')
+
+    return backend
+
+
+# Workspace of the current process, set on every processing job
+def get_workspace():
+    return os.getenv('WORKSPACE') or None
+
+
+def check_workspace(workspace):
+    if not WORKSPACE_NAME.fullmatch(workspace):
+        raise ValueError(f'Invalid workspace name {workspace!r}. Use up to 60 lowercase letters, digits and '
+                         f'underscores.')
+
+    return workspace
+
+
+# Postgres schema holding the tables of a workspace
+def get_schema(workspace):
+    return f'ws_{check_workspace(workspace)}'
+
+
+# Directory of the columnar store holding the tables of a workspace
+def get_store_dir(workspace):
+    if workspace is None:
+        return STORE_DIR
+
+    return os.path.join(STORE_DIR, check_workspace(workspace))
+
+
+# Connect to Database, scoped to the tables of a workspace when there is one
+def connect_to_db(workspace=None):
+    workspace = workspace or get_workspace()
+
+    if get_backend() == 'duckdb':
+        return connect_to_duckdb(get_store_dir(workspace))
+
+    user = get_env_variables().get('DB_USER')
+    password = get_env_variables().get('DB_PASS')
+    db_ip = get_env_variables().get('DB_IP')
+    db = get_env_variables().get('DB_NAME')
+
+    connect_args = {}
+
+    # Unqualified table names resolve to the workspace schema
+    if workspace is not None:
+        connect_args['options'] = f'-csearch_path="{get_schema(workspace)}"'
+
+    return create_engine(f'postgresql+psycopg2://{user}:{password}@{db_ip}:5432/{db}', echo=False,
+                         connect_args=connect_args)
+
+
+# Expose every table of the columnar store to an in-memory DuckDB, without copying the data
+def connect_to_duckdb(store_dir=STORE_DIR):
+    conn = duckdb.connect(database=':memory:')
+
+    for table in read_manifest(store_dir):
+        source = pa.memory_map(os.path.join(store_dir, f'{table}.arrow'))
+        conn.register(table, pa.ipc.open_file(source).read_all())
+
+    conn.register('Country_Mapping', pd.read_csv('Files/Country Mapping.csv'))
+
+    return conn
+
+
+# Run a query against either backend
+def run_query(client, statement):
+    # Going through Arrow gives the same NaN and None handling as pandas does for Postgres results
+    if isinstance(client, duckdb.DuckDBPyConnection):
+        return client.execute(statement).fetch_arrow_table().to_pandas()
+
+    return pd.read_sql_query(statement, con=client)
+
+
+# Make a frame available to queries as a table, replacing any table of the same name
+def write_table(client, name, df):
+    if isinstance(client, duckdb.DuckDBPyConnection):
+        client.register(name, df)
+        return
+
+    df.to_sql(name=name, con=client, if_exists='replace', index=False)
+
+
+# Remove a table made with write_table, if it exists
+def drop_table(client, name):
+    if isinstance(client, duckdb.DuckDBPyConnection):
+        client.unregister(name)
+        return
+
+    with client.begin() as conn:
+        conn.execute(text(f'DROP TABLE IF EXISTS {quote_identifier(name)};'))
+
+
+# Run a query and yield its result in frames of at most chunk_size rows, using a server-side cursor on Postgres
+def stream_query(client, statement, chunk_size):
+    if isinstance(client, duckdb.DuckDBPyConnection):
+        for batch in client.execute(statement).fetch_record_batch(chunk_size):
+            yield batch.to_pandas()
+
+        return
+
+    with client.connect().execution_options(stream_results=True, max_row_buffer=chunk_size) as conn:
+        for chunk in pd.read_sql_query(statement, con=conn, chunksize=chunk_size):
+            yield chunk
+
+
+########################################################################################################################
+#                                                  Derived Tables                                                      #
+########################################################################################################################
+
+# RE ID and Live Alumni ID pairs, cast once at load so that stages join on typed, indexed columns
+RE_LA_MAP_QUERY = """
+    SELECT
+        DISTINCT
+        CAST("ConsID" AS BIGINT) AS re_id,
+        CAST("CAttrDesc" AS BIGINT) AS la_id
+    FROM
+        "Custom_Fields"
+    WHERE
+        "CAttrCat" = 'Live Alumni ID'
+"""
+
+# One row per position of each Live Alumni record, with only the columns the organisation stage reads. position_rank
+# orders the positions of a person: primary, then current, then the most recent ones. Byte order ("C") breaks the ties
+# the same way on both backends.
+LA_EMPLOYMENT_QUERY = """
+    SELECT
+        *,
+        ROW_NUMBER() OVER (
+            PARTITION BY personid
+            ORDER BY
+                "Employment Position Is Primary" DESC NULLS LAST,
+                "Employment Position Is Current" DESC NULLS LAST,
+                "Employment Start Year" DESC NULLS LAST,
+                "Employment Start Month" DESC NULLS LAST,
+                "Employment Company Name" COLLATE "C",
+                "Employment Title" COLLATE "C" NULLS LAST,
+                "Employment End Year" DESC NULLS LAST,
+                "Employment End Month" DESC NULLS LAST,
+                "Company Record Standardized Name" COLLATE "C" NULLS LAST,
+                "Employment Salary Min" NULLS LAST,
+                "Employment Salary Max" NULLS LAST,
+                "Company Industry Name" COLLATE "C" NULLS LAST,
+                "Employment Title Is Senior" NULLS LAST,
+                "Company Type Type" COLLATE "C" NULLS LAST,
+                "Company Details Size" COLLATE "C" NULLS LAST,
+                "Company Details Sector" COLLATE "C" NULLS LAST,
+                "Person Headline" COLLATE "C" NULLS LAST
+        ) AS position_rank
+    FROM (
+        SELECT
+            DISTINCT
+            personid,
+            "Employment Company Name",
+            "Employment Title",
+            "Employment Start Year",
+            "Employment Start Month",
+            "Employment End Year",
+            "Employment End Month",
+            "Company Industry Name",
+            "Employment Position Is Current",
+            "Employment Position Is Primary",
+            "Employment Title Is Senior",
+            "Employment Salary Min",
+            "Employment Salary Max",
+            "Company Record Standardized Name",
+            "Company Type Type",
+            "Company Details Size",
+            "Company Details Sector",
+            "Person Headline"
+        FROM
+            "Live_Alumni"
+        WHERE
+            "Employment Company Name" IS NOT NULL
+    ) AS positions
+"""
+
+# Tables derived from the uploads once at load, with the upload each one is built from and the columns to index
+DERIVED_TABLES = {
+    're_la_map': {'query': RE_LA_MAP_QUERY, 'source': 'Custom_Fields', 'indexes': ['la_id', 're_id']},
+    'la_employment': {'query': LA_EMPLOYMENT_QUERY, 'source': 'Live_Alumni', 'indexes': ['personid']}
+}
+
+
+# Materialise a derived table, either in the workspace schema or in the columnar store
+def build_derived_table(client, table, store_dir=STORE_DIR):
+    query = DERIVED_TABLES[table]['query']
+
+    if isinstance(client, duckdb.DuckDBPyConnection):
+        data = client.execute(query).fetch_arrow_table()
+
+        with pa.ipc.new_file(os.path.join(store_dir, f'{table}.arrow'), data.schema) as writer:
+            writer.write_table(data)
+
+        # Recorded against the upload it was built from, so that a new upload of it rebuilds the table
+        manifest = read_manifest(store_dir)
+        manifest[table] = {
+            'file': None,
+            'digest': manifest[DERIVED_TABLES[table]['source']]['digest'],
+            'schema_version': SCHEMA_VERSION,
+            'rows': data.num_rows
+        }
+        write_manifest(manifest, store_dir)
+
+        client.register(table, data)
+
+        return
+
+    with client.begin() as conn:
+        conn.execute(text(f'DROP TABLE IF EXISTS {table};'))
+        conn.execute(text(f'CREATE TABLE {table} AS {query};'))
+
+        for col in DERIVED_TABLES[table]['indexes']:
+            conn.execute(text(f'CREATE INDEX ON {table} ({col});'))
+
+        conn.execute(text(f'ANALYZE {table};'))
+
+
+def build_derived_tables(client, store_dir=STORE_DIR):
+    for table in DERIVED_TABLES:
+        build_derived_table(client, table, store_dir)
+
+
+# Build the derived tables missing from the loaded data, or whose upload changed since they were built
+def ensure_derived_tables(client, store_dir=STORE_DIR):
+    manifest = read_manifest(store_dir) if isinstance(client, duckdb.DuckDBPyConnection) else None
+
+    for table, derived in DERIVED_TABLES.items():
+        if manifest is not None:
+            if manifest.get(table, {}).get('digest') == manifest.get(derived['source'], {}).get('digest'):
+                continue
+
+        elif inspect(client).has_table(table):
+            continue
+
+        print(f'Building {table}...\n')
+        build_derived_table(client, table, store_dir)
+
+
+########################################################################################################################
+#                                                    Bulk Loading                                                      #
+########################################################################################################################
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+# Postgres type of an Arrow column
+def pg_type(arrow_type):
+    if pa.types.is_integer(arrow_type):
+        return 'bigint'
+
+    if pa.types.is_floating(arrow_type):
+        return 'double precision'
+
+    if pa.types.is_boolean(arrow_type):
+        return 'boolean'
+
+    if pa.types.is_timestamp(arrow_type):
+        return 'timestamp'
+
+    if pa.types.is_date(arrow_type):
+        return 'date'
+
+    return 'text'
+
+
+# Stream a CSV file into a typed Postgres table with COPY, a batch at a time, so that the file is never held in memory
+def copy_batch(cur, target, columns, batch):
+    buffer = BytesIO()
+    pa_csv.write_csv(batch, buffer)
+    buffer.seek(0)
+
+    cur.copy_expert(f"COPY {target} ({columns}) FROM STDIN WITH (FORMAT csv, HEADER true, ENCODING 'UTF8');", buffer)
+
+
+# Load an upload into its table, and the columns it isn't declared with into its sidecar table, if it has one. The
+# JSON documents of the sidecar are compressed by Postgres, being stored out of line.
+def bulk_load(client, path, file_name, table, schema=None, rejects=None):
+    rejects = rejects or RejectLog()
+
+    def qualify(name):
+        return f'{quote_identifier(schema)}.{quote_identifier(name)}' if schema else quote_identifier(name)
+
+    target = qualify(table)
+    fields = typed_schema(path, file_name)
+    columns = ', '.join(quote_identifier(field.name) for field in fields)
+
+    extra_target = qualify(sidecar_table(file_name))
+    extra_fields = sidecar_schema(file_name) if extra_columns(path, file_name) else None
+
+    conn = client.raw_connection()
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'DROP TABLE IF EXISTS {target};')
+            cur.execute(
+                f"CREATE TABLE {target} "
+                f"({', '.join(f'{quote_identifier(field.name)} {pg_type(field.type)}' for field in fields)});"
+            )
+
+            # A sidecar of an earlier load would not match this one
+            cur.execute(f'DROP TABLE IF EXISTS {extra_target};')
+
+            if extra_fields is not None:
+                key = quote_identifier(extra_fields.names[0])
+                cur.execute(f'CREATE TABLE {extra_target} ({key} {pg_type(extra_fields.types[0])}, "data" jsonb);')
+
+            for batch, extra in read_projected_batches(path, file_name, rejects):
+                copy_batch(cur, target, columns, batch)
+
+                if extra is not None:
+                    copy_batch(cur, extra_target, f'{key}, "data"', extra)
+
+            # Keys and import IDs are what the stages join on and look up the highest value of
+            for col in KEY_COLUMNS.get(file_name, []) + [shadow_column(col) for col in import_id_columns(file_name)]:
+                if col in fields.names:
+                    cur.execute(f'CREATE INDEX ON {target} ({quote_identifier(col)});')
+
+            cur.execute(f'ANALYZE {target};')
+
+            if extra_fields is not None:
+                cur.execute(f'CREATE INDEX ON {extra_target} ({key});')
+                cur.execute(f'ANALYZE {extra_target};')
+
+        conn.commit()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+    return table
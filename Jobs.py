@@ -0,0 +1,253 @@
+import pandas as pd
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import uuid
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from State import connect_to_state
+from Metrics import record_job
+from Workspaces import WORKSPACE_TTL_HOURS, touch_workspace, cleanup_workspaces
+
+# Where each job keeps its log and results
+JOBS_DIR = os.getenv('JOBS_DIR', 'Jobs')
+
+# Number of processing runs allowed at the same time
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '1'))
+
+# Stages logged by Processing.py, used to work out the progress of a job
+STAGES = ['Mapping', 'Change Detection', 'Organisations', 'LinkedIn', 'Emails', 'Addresses', 'Custom Fields', 'Export']
+
+
+########################################################################################################################
+#                                                    Job Table                                                         #
+########################################################################################################################
+
+def initialize_jobs():
+    conn = connect_to_state()
+
+    with conn:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                options TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                started_at TEXT,
+                finished_at TEXT,
+                return_code INTEGER
+            );
+            """
+        )
+
+    conn.close()
+
+
+def update_job(job_id, **fields):
+    conn = connect_to_state()
+
+    with conn:
+        conn.execute(
+            f"UPDATE jobs SET {', '.join(f'{field} = ?' for field in fields)} WHERE job_id = ?;",
+            (*fields.values(), job_id)
+        )
+
+    conn.close()
+
+
+def get_jobs(limit=50):
+    conn = connect_to_state()
+
+    jobs = pd.read_sql_query(
+        'SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?;', con=conn, params=(limit,)
+    )
+
+    conn.close()
+
+    jobs['progress'] = jobs['job_id'].map(get_progress)
+
+    return jobs
+
+
+def get_job_dir(job_id):
+    return os.path.join(JOBS_DIR, job_id)
+
+
+def get_output_dir(job_id):
+    return os.path.join(get_job_dir(job_id), 'Final')
+
+
+def get_log_file(job_id):
+    return os.path.join(get_job_dir(job_id), 'run.log')
+
+
+########################################################################################################################
+#                                                     Workers                                                          #
+########################################################################################################################
+
+def run_job(job_id, options):
+    update_job(job_id, status='running', started_at=pd.Timestamp.now().isoformat(timespec='seconds'))
+
+    if options.get('WORKSPACE'):
+        touch_workspace(options['WORKSPACE'])
+
+    os.makedirs(get_output_dir(job_id), exist_ok=True)
+
+    env = os.environ.copy()
+    env.update(options)
+    env['OUTPUT_DIR'] = get_output_dir(job_id)
+
+    start = time.perf_counter()
+
+    try:
+        with open(get_log_file(job_id), 'w') as log:
+            result = subprocess.run([sys.executable, '-u', 'Processing.py'], stdout=log, stderr=subprocess.STDOUT,
+                                    env=env)
+
+        return_code = result.returncode
+
+    except Exception as e:
+        with open(get_log_file(job_id), 'a') as log:
+            log.write(f'\n{e}\n')
+
+        return_code = -1
+
+    # Processing.py reports errors in its log, so only a complete set of stages counts as success
+    status = 'succeeded' if return_code == 0 and get_progress(job_id) == 1 else 'failed'
+
+    update_job(job_id, status=status, return_code=return_code,
+               finished_at=pd.Timestamp.now().isoformat(timespec='seconds'))
+
+    record_job(status, time.perf_counter() - start, read_run_metrics(job_id))
+
+
+# Queue a processing run, on the tables of the given workspace when there is one
+def submit_job(options=None, workspace=None):
+    options = dict(options or {})
+    job_id = uuid.uuid4().hex[:12]
+
+    if workspace is not None:
+        options['WORKSPACE'] = workspace
+        touch_workspace(workspace)
+
+    cleanup()
+
+    os.makedirs(get_job_dir(job_id), exist_ok=True)
+
+    conn = connect_to_state()
+
+    with conn:
+        conn.execute(
+            'INSERT INTO jobs (job_id, status, options, created_at) VALUES (?, ?, ?, ?);',
+            (job_id, 'queued', json.dumps(options), pd.Timestamp.now().isoformat(timespec='seconds'))
+        )
+
+    conn.close()
+
+    executor.submit(run_job, job_id, options)
+
+    return job_id
+
+
+# Jobs of a previous server process: queued ones are picked up again, running ones were cut short
+def recover_jobs():
+    conn = connect_to_state()
+
+    with conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'interrupted', finished_at = ? WHERE status = 'running';",
+            (pd.Timestamp.now().isoformat(timespec='seconds'),)
+        )
+
+    queued = conn.execute("SELECT job_id, options FROM jobs WHERE status = 'queued' ORDER BY created_at;").fetchall()
+
+    conn.close()
+
+    for job_id, options in queued:
+        executor.submit(run_job, job_id, json.loads(options))
+
+
+########################################################################################################################
+#                                                 Progress & Results                                                   #
+########################################################################################################################
+
+def read_log(job_id, lines=200):
+    if not os.path.exists(get_log_file(job_id)):
+        return ''
+
+    with open(get_log_file(job_id)) as f:
+        return ''.join(f.readlines()[-lines:])
+
+
+# Stage metrics reported by Processing.py, when it got far enough to write them
+def read_run_metrics(job_id):
+    metrics_file = os.path.join(get_output_dir(job_id), 'Run Metrics.json')
+
+    if not os.path.exists(metrics_file):
+        return []
+
+    with open(metrics_file) as f:
+        return json.load(f)['stages']
+
+
+# Share of the stages either completed or reused from a checkpoint
+def get_progress(job_id):
+    log = read_log(job_id, lines=100000)
+
+    done = sum(
+        f'Finished {stage} in' in log or f'Reusing the checkpoint of {stage}...' in log for stage in STAGES
+    )
+
+    return done / len(STAGES)
+
+
+def zip_results(job_id):
+    b = BytesIO()
+
+    with zipfile.ZipFile(b, 'w') as zip_files:
+        directory = get_output_dir(job_id)
+        for filename in os.listdir(directory):
+            if filename.endswith('.csv'):
+                zip_files.write(os.path.join(directory, filename), arcname=os.path.join('Final', filename))
+
+    b.seek(0)
+
+    return b
+
+
+########################################################################################################################
+#                                                      Cleanup                                                         #
+########################################################################################################################
+
+# Remove the results of jobs finished more than WORKSPACE_TTL_HOURS ago, then the workspaces no longer used
+def cleanup():
+    expiry = (pd.Timestamp.now() - pd.Timedelta(hours=WORKSPACE_TTL_HOURS)).isoformat(timespec='seconds')
+
+    conn = connect_to_state()
+
+    expired = conn.execute(
+        "SELECT job_id FROM jobs WHERE status NOT IN ('queued', 'running') AND finished_at < ?;", (expiry,)
+    ).fetchall()
+
+    for (job_id,) in expired:
+        shutil.rmtree(get_job_dir(job_id), ignore_errors=True)
+
+    with conn:
+        conn.executemany('DELETE FROM jobs WHERE job_id = ?;', expired)
+
+    conn.close()
+
+    cleanup_workspaces()
+
+
+# Module level, so that the queue outlives Streamlit reruns and is shared by every session
+initialize_jobs()
+cleanup()
+executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+recover_jobs()
@@ -0,0 +1,85 @@
+import pandas as pd
+import numpy as np
+
+# Only the columns used for matching are read from each upload
+MATCH_COLUMNS = {
+    'Live Alumni.csv': [
+        'personid', 'Person URL', 'Person Constituent ID', 'Person Level 1 Constituent ID',
+        'Person Level 2 Constituent ID'
+    ],
+    'Custom Fields.csv': ['CAttrImpID', 'CAttrCat', 'ConsID', 'CAttrDesc'],
+    'Phone List.csv': ['ConsID', 'PhoneType', 'PhoneNum', 'PhoneIsInactive']
+}
+
+
+def clean_linkedin(url):
+    if url.endswith('/'):
+        url = url[:-1]
+
+    return url.replace('https://www.', '').replace('http://www.', '').replace('www.', '')
+
+
+def format_import_id(import_id):
+    return str(import_id)[0:5] + '-' + str(import_id)[5:8] + '-' + str(import_id)[-10:]
+
+
+# Live Alumni records not yet linked in RE, as Custom Fields to import
+def identify_new_matches(live_alumni, custom_fields, phones, manual):
+    custom_fields_1 = custom_fields[custom_fields['CAttrCat'] == 'Live Alumni ID'][
+        ['ConsID', 'CAttrDesc']].copy()
+
+    live_alumni_1 = live_alumni.melt(
+        id_vars='personid',
+        value_name='ConsID',
+        var_name='Type',
+        value_vars=['Person Constituent ID', 'Person Level 1 Constituent ID', 'Person Level 2 Constituent ID']
+    ).drop_duplicates(subset=['personid']).dropna().drop(columns='Type').sort_values(by=['ConsID'])
+
+    new_matches_1 = live_alumni_1[
+        ~(live_alumni_1['ConsID'].astype(int).isin(custom_fields_1['ConsID'].astype(int))) &
+        ~(live_alumni_1['personid'].astype(int).isin(custom_fields_1['CAttrDesc'].astype(int)))
+        ]
+
+    phones = phones[
+        (phones['PhoneType'].str.lower().str.contains('linkedin', na=False)) &
+        (phones['PhoneIsInactive'].ne(True))
+        ][['ConsID', 'PhoneNum']].dropna()
+
+    phones['PhoneNum'] = phones['PhoneNum'].apply(lambda x: clean_linkedin(x))
+
+    # Alumni without a LinkedIn profile can only be matched on their constituent IDs
+    live_alumni_2 = live_alumni[['personid', 'Person URL']].dropna().drop_duplicates().copy()
+
+    live_alumni_2['Person URL'] = live_alumni_2['Person URL'].apply(lambda x: clean_linkedin(x))
+
+    new_matches_2 = live_alumni_2[
+        (live_alumni_2['Person URL'].isin(phones['PhoneNum'])) &
+        ~(live_alumni_2['personid'].astype(int).isin(custom_fields_1['CAttrDesc'].astype(int)))
+        ].copy()
+
+    new_matches_2 = new_matches_2.merge(phones, left_on='Person URL', right_on='PhoneNum', how='left')[
+        ['personid', 'ConsID']]
+
+    new_matches = pd.concat([new_matches_1, new_matches_2, manual], axis=0, ignore_index=True)
+
+    new_matches.drop_duplicates(inplace=True)
+
+    max_id = custom_fields['CAttrImpID'].replace('[^0-9]', '', regex=True).astype(int).sort_values(
+        ascending=False)[0] + 9999999999
+
+    new_matches_data = pd.DataFrame(data={
+        'CAttrImpID': np.arange(max_id, max_id + new_matches.shape[0]),
+        'CAttrCat': 'Live Alumni ID',
+        'CAttrCom': np.nan,
+        'ConsID': new_matches['ConsID'].astype(int).values,
+        'CAttrDate': pd.to_datetime('today').strftime('%d-%b-%Y'),
+        'CAttrDesc': new_matches['personid'].values
+    })
+
+    new_matches_data['CAttrImpID'] = new_matches_data['CAttrImpID'].apply(lambda x: format_import_id(x))
+
+    return new_matches_data
+
+
+def export_matches(new_matches_data, filename):
+    new_matches_data.to_csv(filename, quoting=1, lineterminator='\r\n', index=False)
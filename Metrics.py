@@ -0,0 +1,230 @@
+import os
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sqlalchemy import text
+from Database import get_backend, connect_to_db
+from State import connect_to_state
+
+# Port of the metrics endpoint, in the Prometheus text format. 0 turns it off.
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+
+SECONDS_BUCKETS = [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+BYTES_BUCKETS = [1024 ** 2, 10 * 1024 ** 2, 50 * 1024 ** 2, 100 * 1024 ** 2, 500 * 1024 ** 2, 1024 ** 3, 5 * 1024 ** 3]
+ROWS_BUCKETS = [1000, 10000, 100000, 1000000, 10000000]
+
+# Type, help text and buckets of every metric
+METRICS = {
+    'live_alumni_file_loads_total': ('counter', 'Uploaded files loaded, by file and status', None),
+    'live_alumni_file_load_seconds': ('histogram', 'Time to validate and load an uploaded file', SECONDS_BUCKETS),
+    'live_alumni_file_load_bytes': ('histogram', 'Size of the uploaded files loaded', BYTES_BUCKETS),
+    'live_alumni_file_load_rows': ('histogram', 'Rows of the uploaded files loaded', ROWS_BUCKETS),
+    'live_alumni_jobs_total': ('counter', 'Processing runs finished, by status', None),
+    'live_alumni_job_duration_seconds': ('histogram', 'Wall time of the processing runs', SECONDS_BUCKETS),
+    'live_alumni_stage_duration_seconds': ('histogram', 'Wall time of the processing stages', SECONDS_BUCKETS),
+    'live_alumni_stage_wait_seconds': ('histogram', 'Wall time of the processing stages not spent on the CPU, '
+                                                    'mostly waiting on the database', SECONDS_BUCKETS),
+    'live_alumni_jobs': ('gauge', 'Processing runs by status. Queued ones make the queue depth.', None),
+    'live_alumni_db_up': ('gauge', 'Whether the Postgres database answered the last scrape', None),
+    'live_alumni_db_connections': ('gauge', 'Connections to the Postgres database, by state', None),
+    'live_alumni_db_max_connections': ('gauge', 'Connections the Postgres database accepts', None)
+}
+
+# Values recorded by this process, by metric and labels
+counters = {}
+histograms = {}
+metrics_lock = threading.Lock()
+
+# Engine kept across scrapes, rather than a new pool every time
+db_engine = None
+
+
+########################################################################################################################
+#                                                     Recording                                                        #
+########################################################################################################################
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+
+    with metrics_lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    buckets = METRICS[name][2]
+
+    with metrics_lock:
+        histogram = histograms.setdefault(key, {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def record_file_load(file_name, size, rows, seconds):
+    inc('live_alumni_file_loads_total', file=file_name, status='loaded')
+    observe('live_alumni_file_load_seconds', seconds, file=file_name)
+    observe('live_alumni_file_load_bytes', size, file=file_name)
+    observe('live_alumni_file_load_rows', rows, file=file_name)
+
+
+# A finished processing run, with the stage metrics it reported
+def record_job(status, seconds, stages):
+    inc('live_alumni_jobs_total', status=status)
+    observe('live_alumni_job_duration_seconds', seconds, status=status)
+
+    for stage in stages:
+        observe('live_alumni_stage_duration_seconds', stage['wall_time_s'], stage=stage['stage'])
+        observe('live_alumni_stage_wait_seconds', max(stage['wall_time_s'] - stage['cpu_time_s'], 0),
+                stage=stage['stage'])
+
+
+########################################################################################################################
+#                                                     Exposition                                                       #
+########################################################################################################################
+
+# Values read at scrape time, from the job table and from Postgres
+def collect_gauges():
+    global db_engine
+
+    conn = connect_to_state()
+
+    try:
+        jobs = dict(conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status;').fetchall())
+
+    # No job table before the Process page was first opened
+    except Exception:
+        jobs = {}
+
+    finally:
+        conn.close()
+
+    gauges = [
+        ('live_alumni_jobs', {'status': status}, jobs.get(status, 0))
+        for status in ['queued', 'running', 'succeeded', 'failed', 'interrupted']
+    ]
+
+    if get_backend() != 'postgres':
+        return gauges
+
+    try:
+        db_engine = db_engine or connect_to_db()
+
+        with db_engine.connect() as db:
+            connections = db.execute(text(
+                """
+                SELECT
+                    COALESCE(state, 'background') AS state,
+                    COUNT(*) AS n
+                FROM
+                    pg_stat_activity
+                WHERE
+                    datname = current_database()
+                GROUP BY
+                    1;
+                """
+            )).fetchall()
+
+            max_connections = db.execute(text('SHOW max_connections;')).scalar()
+
+    except Exception:
+        return gauges + [('live_alumni_db_up', {}, 0)]
+
+    return gauges + [('live_alumni_db_up', {}, 1), ('live_alumni_db_max_connections', {}, int(max_connections))] + [
+        ('live_alumni_db_connections', {'state': state}, n) for state, n in connections
+    ]
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    values = [
+        f'{key}="' + str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') + '"'
+        for key, value in labels
+    ]
+
+    return '{' + ','.join(values) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Every metric in the Prometheus text format
+def render_metrics():
+    gauges = {}
+
+    for name, labels, value in collect_gauges():
+        gauges.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+
+    with metrics_lock:
+        lines = []
+
+        for name, (metric_type, description, buckets) in METRICS.items():
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {metric_type}']
+
+            if metric_type == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+
+            elif metric_type == 'histogram':
+                for (metric, labels), histogram in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+
+                    for bound, count in zip(buckets + ['+Inf'], histogram['buckets'] + [histogram['count']]):
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+
+                    lines.append(f"{name}_sum{format_labels(labels)} {format_value(histogram['sum'])}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+
+            else:
+                for labels, value in gauges.get(name, []):
+                    lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = render_metrics().encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes are not worth a line in the app log
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server(port=METRICS_PORT):
+    if not port:
+        return None
+
+    try:
+        server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+
+    except OSError as e:
+        print(f'Unable to serve metrics on port {port}: {e}')
+        return None
+
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+
+    return server
+
+
+# Module level, so that the endpoint outlives Streamlit reruns and counts the loads and runs of every session
+metrics_server = start_metrics_server()
@@ -1,273 +1,614 @@
 import pandas as pd
 import numpy as np
+import hashlib
 import os
 import random
+import json
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
 
-from sqlalchemy import create_engine
-from urllib.parse import quote_plus
+from collections import Counter
+from contextlib import contextmanager
+
+from sqlalchemy import event
 
 from fuzzywuzzy import fuzz
 from fuzzywuzzy import process
 from tabulate import tabulate
+from Database import get_backend, connect_to_db, run_query, stream_query, write_table, drop_table, get_workspace, \
+    get_store_dir, ensure_derived_tables
+from State import connect_to_state
+from StageCache import load_result, save_result
 
 
-# Load Environment variables
-def get_env_variables():
-    return {
-        'DB_IP': os.getenv('DB_IP'),
-        'DB_USER': os.getenv('DB_USER'),
-        'DB_PASS': quote_plus(os.getenv('DB_PASS')),
-        'DB_NAME': os.getenv('DB_NAME')
+# Read an on/off switch from the environment
+def env_flag(name):
+    return os.getenv(name, 'false').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# Run query and record what was fetched against the active stage
+def read_sql(query):
+    df = run_query(client, query)
+
+    if active_stage:
+        active_stage['db_queries'] += 1
+        active_stage['rows_in'] += df.shape[0]
+        active_stage['bytes_fetched'] += int(df.memory_usage(index=False, deep=True).sum())
+
+    return df
+
+
+# Read a large result set in chunks of STREAM_CHUNK_SIZE rows, or all at once when streaming is off
+def read_sql_chunks(query):
+    chunk_size = int(os.getenv('STREAM_CHUNK_SIZE', '0'))
+
+    if chunk_size <= 0:
+        yield read_sql(query)
+        return
+
+    for df in stream_query(client, query, chunk_size):
+        if active_stage:
+            active_stage['db_queries'] += 1
+            active_stage['rows_in'] += df.shape[0]
+            active_stage['bytes_fetched'] += int(df.memory_usage(index=False, deep=True).sum())
+
+        yield df
+
+
+# Measure wall time, CPU time, rows and queries of a stage, and its peak memory with PROFILE_MEMORY
+@contextmanager
+def track_stage(name):
+    global active_stage
+
+    active_stage = {
+        'stage': name,
+        'wall_time_s': 0.0,
+        'cpu_time_s': 0.0,
+        'rows_in': 0,
+        'rows_out': 0,
+        'db_queries': 0,
+        'bytes_fetched': 0,
+        'peak_memory_mb': None,
+        'status': 'completed'
     }
+    stage = active_stage
 
+    if trace_memory:
+        tracemalloc.start()
 
-# Connect to Database
-def connect_to_db():
-    print('Connecting to database...')
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
 
-    user = get_env_variables().get('DB_USER')
-    password = get_env_variables().get('DB_PASS')
-    db_ip = get_env_variables().get('DB_IP')
-    db = get_env_variables().get('DB_NAME')
+    try:
+        yield stage
 
-    return create_engine(f'postgresql+psycopg2://{user}:{password}@{db_ip}:5432/{db}', echo=False)
+    except Exception:
+        stage['status'] = 'failed'
+        raise
 
+    finally:
+        stage['wall_time_s'] = round(time.perf_counter() - wall_start, 3)
+        stage['cpu_time_s'] = round(time.process_time() - cpu_start, 3)
 
-def sync_organisations():
-    # Create Blank Dataframe
-    org_df = pd.DataFrame()
-    org_attributes_df = pd.DataFrame()
+        if trace_memory:
+            stage['peak_memory_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 ** 2, 2)
+            tracemalloc.stop()
 
-    # Get Data from Raisers Edge
-    re_data = pd.read_sql_query(
-        f"""
-                        SELECT
-                            *
-                        FROM
-                            "Org_Relationships"
-                        WHERE
-                            "ConsID" = {re_id};
-                        """,
-        con=client
+        run_metrics.append(stage)
+        active_stage = {}
+
+        print(f"{'Finished' if stage['status'] == 'completed' else 'Failed'} {name} in {stage['wall_time_s']}s "
+              f"({stage['db_queries']} queries, {stage['rows_out']} rows out)\n")
+
+
+def export_metrics(filename):
+    print(f'\nExporting run metrics to {filename}...\n')
+
+    with open(os.path.join(OUTPUT_DIR, filename), 'w') as f:
+        json.dump({
+            'generated_at': pd.Timestamp.now().isoformat(timespec='seconds'),
+            'stages': run_metrics
+        }, f, indent=2)
+
+
+# Reduce a statement to its shape by replacing literals with placeholders, keeping quoted column names
+def normalise_query(statement):
+    statement = re.sub(
+        r'("(?:[^"]|"")*")|(\'(?:[^\']|\'\')*\')|(\b\d+(?:\.\d+)?\b)',
+        lambda m: m.group(1) if m.group(1) else '?',
+        statement
     )
 
-    # Get Data from Live Alumni
-    la_data = pd.read_sql_query(
-        f"""
-        SELECT DISTINCT
-            "Personal Industry Name",
-            "Employment Company Name",
-            "Employment Title",
-            "Employment Start Year",
-            "Employment Start Month",
-            "Employment End Year",
-            "Employment End Month",
-            "Company Industry Name",
-            "Employment Position Is Current",
-            "Employment Position Is Primary",
-            "Employment Title Is Senior",
-            "Employment Salary Min",
-            "Employment Salary Max",
-            "Employment Seniority Level",
-            "Company Record Standardized Name",
-            "Company Record Historic Head Count",
-            "Company Record Current Head Count",
-            "Company Type Type",
-            "Company Details Size",
-            "Company Details Sector",
-            "Company Details Website",
-            "Person Headline"
-        FROM
-            "Live_Alumni"
-        WHERE
-            personid = {la_id};
-        """,
-        con=client
+    # Collapse IN lists of any length
+    statement = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?)', statement)
+
+    return ' '.join(statement.split())
+
+
+# Record duration and row count of every statement executed through the engine, aggregated by query shape
+def attach_query_profiler(engine, slow_query_ms):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration_ms = (time.perf_counter() - conn.info['query_start'].pop()) * 1000
+        rows = max(cursor.rowcount, 0)
+        shape = normalise_query(statement)
+
+        profile = query_profile.setdefault(shape, {
+            'query': shape,
+            'calls': 0,
+            'total_ms': 0.0,
+            'max_ms': 0.0,
+            'rows': 0,
+            'sample_parameters': repr(parameters)[:200]
+        })
+        profile['calls'] += 1
+        profile['total_ms'] += duration_ms
+        profile['max_ms'] = max(profile['max_ms'], duration_ms)
+        profile['rows'] += rows
+
+        # Keep the slowest instance of each shape for EXPLAIN
+        if duration_ms >= slow_query_ms and duration_ms >= slow_queries.get(shape, {}).get('duration_ms', 0):
+            slow_queries[shape] = {
+                'query': shape,
+                'duration_ms': round(duration_ms, 2),
+                'rows': rows,
+                'statement': statement,
+                'parameters': parameters
+            }
+
+
+# Capture EXPLAIN (ANALYZE, BUFFERS) for the slow queries once the run is over, so that it doesn't skew the stage times
+def capture_query_plans():
+    conn = client.raw_connection()
+
+    try:
+        for slow_query in slow_queries.values():
+            statement = slow_query.pop('statement')
+            parameters = slow_query.pop('parameters')
+
+            if not statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+                continue
+
+            try:
+                cursor = conn.cursor()
+                cursor.execute(f'EXPLAIN (ANALYZE, BUFFERS) {statement}', parameters or None)
+                slow_query['plan'] = '\n'.join(row[0] for row in cursor.fetchall())
+                cursor.close()
+
+            except Exception as e:
+                conn.rollback()
+                slow_query['plan'] = f'Unable to EXPLAIN: {e}'
+
+    finally:
+        conn.close()
+
+
+def export_query_profile(filename):
+    print(f'\nExporting SQL profile to {filename}...\n')
+
+    if slow_queries:
+        capture_query_plans()
+
+    profile = pd.DataFrame(list(query_profile.values()), columns=[
+        'query', 'calls', 'total_ms', 'max_ms', 'rows', 'sample_parameters'
+    ]).sort_values(by='total_ms', ascending=False)
+
+    profile['avg_ms'] = (profile['total_ms'] / profile['calls']).round(2)
+    profile[['total_ms', 'max_ms']] = profile[['total_ms', 'max_ms']].round(2)
+
+    print(tabulate(profile[['calls', 'total_ms', 'avg_ms', 'max_ms', 'rows', 'query']].head(10).assign(
+        query=profile['query'].str[:80]), headers='keys', tablefmt='pretty', showindex=False))
+
+    with open(os.path.join(OUTPUT_DIR, filename), 'w') as f:
+        json.dump({
+            'generated_at': pd.Timestamp.now().isoformat(timespec='seconds'),
+            'queries': profile.to_dict(orient='records'),
+            'slow_queries': list(slow_queries.values())
+        }, f, indent=2, default=str)
+
+
+########################################################################################################################
+#                                                    CPU Profile                                                       #
+########################################################################################################################
+
+# Sample the stack of a thread every interval seconds until stopped, counting each stack against the running stage.
+# Sampling wall time rather than tracing every call keeps the overhead low, and shows the time spent waiting on queries.
+def sample_stacks(thread_id, interval, stop):
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+
+        stack_samples[(active_stage.get('stage', 'Other'),) + tuple(reversed(stack))] += 1
+
+
+# Profile the calling thread, until stop_cpu_profiler is called with what this returns
+def start_cpu_profiler(interval_ms):
+    global profile_interval_ms
+
+    profile_interval_ms = interval_ms
+    stop = threading.Event()
+
+    sampler = threading.Thread(
+        target=sample_stacks, args=(threading.get_ident(), interval_ms / 1000, stop), daemon=True
     )
+    sampler.start()
 
-    # Check if there's any data for the record in RE and LA
-    if la_data.shape[0] and la_data['Employment Company Name'].values[0] is not None:
+    return sampler, stop
 
-        # Export RE Organisations to list
-        re_list = re_data['ORFullName'].drop_duplicates().dropna().tolist()
 
-        # Identifying Start Date
-        start_month = int(la_data['Employment Start Month'].values[0]) if la_data['Employment Start Month'].values[
-                                                                              0] is not None else random.randint(1, 12)
-        try:
-            start_year = int(la_data['Employment Start Year'].values[0]) if la_data['Employment Start Year'].values[
-                                                                                0] is not None else 0
-        except ValueError:
-            start_year = 0
-
-        # Identifying End Date
-        end_month = int(la_data['Employment End Month'].values[0]) if la_data['Employment End Month'].values[
-                                                                          0] is not None else random.randint(1, 12)
-        try:
-            end_year = int(la_data['Employment End Year'].values[0]) if la_data['Employment End Year'].values[
-                                                                            0] is not None else 0
-        except ValueError:
-            end_year = 0
+# Wait for the sampler to count its last sample, so that the samples no longer change while they are exported
+def stop_cpu_profiler(profiler):
+    sampler, stop = profiler
 
-        # Identifying Salary Range
-        try:
-            min_salary = int(la_data['Employment Salary Min'].values[0]) if la_data['Employment Salary Min'].values[
-                                                                                0] is not None else 0
-        except ValueError:
-            min_salary = 0
+    stop.set()
+    sampler.join()
 
-        try:
-            max_salary = int(la_data['Employment Salary Max'].values[0]) if la_data['Employment Salary Max'].values[
-                                                                                0] is not None else 0
-        except ValueError:
-            max_salary = 0
-
-        # Check if organisation is new/old
-        match = process.extractOne(
-            query=la_data['Employment Company Name'].values[0],
-            choices=re_list,
-            scorer=fuzz.ratio,
-            score_cutoff=90
+
+# Write the sampled stacks in the collapsed format of flame graph tools, and the functions most samples were in
+def export_cpu_profile(filename):
+    print(f'\nExporting CPU profile to {filename}...\n')
+
+    with open(os.path.join(OUTPUT_DIR, f'{os.path.splitext(filename)[0]}.folded'), 'w') as f:
+        for stack, samples in stack_samples.most_common():
+            f.write(f"{';'.join(stack)} {samples}\n")
+
+    hotspots = {}
+
+    for (stage, *frames), samples in stack_samples.items():
+        # Recursive functions are only counted once per sample
+        for function in set(frames):
+            hotspot = hotspots.setdefault((stage, function), {
+                'stage': stage, 'function': function, 'self_samples': 0, 'total_samples': 0
+            })
+            hotspot['total_samples'] += samples
+
+        if frames:
+            hotspots[(stage, frames[-1])]['self_samples'] += samples
+
+    profile = pd.DataFrame(list(hotspots.values()), columns=[
+        'stage', 'function', 'self_samples', 'total_samples'
+    ]).sort_values(by=['self_samples', 'total_samples'], ascending=False).head(CPU_HOTSPOTS)
+
+    profile['self_s'] = (profile['self_samples'] * profile_interval_ms / 1000).round(3)
+    profile['total_s'] = (profile['total_samples'] * profile_interval_ms / 1000).round(3)
+
+    print(tabulate(profile[['stage', 'self_s', 'total_s', 'function']].head(10), headers='keys', tablefmt='pretty',
+                   showindex=False))
+
+    with open(os.path.join(OUTPUT_DIR, filename), 'w') as f:
+        json.dump({
+            'generated_at': pd.Timestamp.now().isoformat(timespec='seconds'),
+            'interval_ms': profile_interval_ms,
+            'samples': sum(stack_samples.values()),
+            'hotspots': profile.to_dict(orient='records')
+        }, f, indent=2)
+
+
+########################################################################################################################
+#                                                Employer Match Cache                                                  #
+########################################################################################################################
+
+# Bump whenever the way employers are matched changes, so that older decisions are not reused
+MATCH_CACHE_VERSION = 1
+
+
+def normalise_company(name):
+    return ' '.join(str(name).lower().split())
+
+
+# Version of a constituent's organisation list in RE, so that decisions are redone once it changes
+def get_org_list_version(re_data):
+    orgs = re_data[['ORFullName', 'ORImpID']].dropna().drop_duplicates().sort_values(by=['ORFullName', 'ORImpID'])
+
+    return hashlib.sha1(orgs.to_csv(index=False).encode()).hexdigest()
+
+
+def load_employer_matches():
+    conn = connect_to_state()
+
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS employer_matches (
+            company TEXT NOT NULL,
+            cons_id INTEGER NOT NULL,
+            org_list_version TEXT NOT NULL,
+            cache_version INTEGER NOT NULL,
+            decision TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            last_used_at TEXT NOT NULL,
+            PRIMARY KEY (company, cons_id, org_list_version, cache_version)
+        );
+        """
+    )
+
+    entries = conn.execute(
+        'SELECT company, cons_id, org_list_version, decision FROM employer_matches WHERE cache_version = ?;',
+        (MATCH_CACHE_VERSION,)
+    ).fetchall()
+
+    conn.close()
+
+    return {
+        'entries': {(company, cons_id, version): decision for company, cons_id, version, decision in entries},
+        'new': {},
+        'hits': set()
+    }
+
+
+def save_employer_matches(matches):
+    now = pd.Timestamp.now().isoformat(timespec='seconds')
+    expiry = (pd.Timestamp.now() - pd.Timedelta(days=int(os.getenv('MATCH_CACHE_TTL_DAYS', '90')))).isoformat(
+        timespec='seconds')
+
+    conn = connect_to_state()
+
+    with conn:
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO employer_matches
+            VALUES (?, ?, ?, ?, ?, ?, ?);
+            """,
+            [(*key, MATCH_CACHE_VERSION, decision, now, now) for key, decision in matches['new'].items()]
         )
 
-        # Old
-        if match is not None:
-            # Update Existing Organisation
-            org_name = match[0]
+        conn.executemany(
+            """
+            UPDATE employer_matches
+            SET last_used_at = ?
+            WHERE company = ? AND cons_id = ? AND org_list_version = ? AND cache_version = ?;
+            """,
+            [(now, *key, MATCH_CACHE_VERSION) for key in matches['hits']]
+        )
+
+        # Evict decisions of older matching logic, and the ones not used for a while
+        conn.execute(
+            'DELETE FROM employer_matches WHERE cache_version != ? OR last_used_at < ?;',
+            (MATCH_CACHE_VERSION, expiry)
+        )
 
-            import_id = re_data[re_data['ORFullName'] == org_name].head(n=1)['ORImpID'].values[0]
+    conn.close()
+
+    print(f"Employer matches: {len(matches['hits'])} reused, {len(matches['new'])} newly matched\n")
+
+
+# Parse a column of whole numbers, treating anything unparseable or not positive as missing
+def to_whole_number(series):
+    values = pd.to_numeric(series, errors='coerce')
+
+    return values.where(values > 0)
+
+
+# Format year and month columns as RE dates, for the first of the month. Missing or invalid months fall back to January.
+def to_re_date(year, month):
+    year = to_whole_number(year)
+    month = to_whole_number(month)
+    month = month.where(month <= 12, 1).fillna(1)
+
+    dates = pd.to_datetime(pd.DataFrame({'year': year, 'month': month, 'day': 1}), errors='coerce')
+
+    return dates.dt.strftime('%d-%b-%Y')
+
+
+# Build the RE organisation relationship columns for every Live Alumni employment row at once
+def build_employment(la_data):
+    min_salary = to_whole_number(la_data['Employment Salary Min'])
+    max_salary = to_whole_number(la_data['Employment Salary Max'])
+
+    income = '$' + min_salary.map('{:,.0f}'.format).astype(str) + ' - $' + max_salary.map('{:,.0f}'.format).astype(str)
+
+    return pd.DataFrame(data={
+        'ConsID': la_data['re_id'].values,
+        'ORImpID': np.nan,
+        'ORFromDate': to_re_date(la_data['Employment Start Year'], la_data['Employment Start Month']).values,
+        'ORToDate': to_re_date(la_data['Employment End Year'], la_data['Employment End Month']).values,
+        'ORIncome': income.where(min_salary.notna() & max_salary.notna()).values,
+        'ORIndustry': la_data['Company Industry Name'].values,
+        'ORIsEmp': True,
+        'ORIsPrimary': la_data['Employment Position Is Primary'].values,
+        'ORFullName': la_data['Company Record Standardized Name'].fillna(la_data['Employment Company Name']).values,
+        'ORNotes': la_data['Person Headline'].values,
+        'ORPos': la_data['Employment Title'].values,
+        'ORProf': la_data['Company Industry Name'].values,
+        'ORRecip': 'Employee',
+        'ORRelat': 'Employer'
+    })
+
+
+# Resolve each (company, constituent) pair to the import ID of an existing RE organisation, or 'new'
+def match_employers(la_data, re_data, employer_matches, org_list_versions):
+    re_orgs = {cons_id: df for cons_id, df in re_data.groupby('ConsID')}
+    no_orgs = re_data.head(0)
+    no_orgs_version = get_org_list_version(no_orgs)
+
+    decisions = {}
+
+    for company, re_id in la_data[['Employment Company Name', 're_id']].drop_duplicates().itertuples(index=False):
+        orgs = re_orgs.get(re_id, no_orgs)
+
+        key = (normalise_company(company), int(re_id), org_list_versions.get(re_id, no_orgs_version))
+
+        # Reusing the decision of an earlier run when nothing changed since
+        if key in employer_matches['entries']:
+            decision = employer_matches['entries'][key]
+            employer_matches['hits'].add(key)
 
-        # New
         else:
-            # Add new Organisation
-            import_id = format_import_id(int(max_org_import_id))
-
-        re_new = pd.DataFrame(data={
-            'ConsID': re_id,
-            'ORImpID': import_id,
-            'ORFromDate': np.NaN if start_year == 0 else pd.to_datetime(f'01-{start_month}-{start_year}',
-                                                                        format='%d-%m-%Y').strftime('%d-%b-%Y'),
-            'ORToDate': np.NaN if end_year == 0 else pd.to_datetime(f'01-{end_month}-{end_year}',
-                                                                    format='%d-%m-%Y').strftime('%d-%b-%Y'),
-            'ORIncome': np.NaN if min_salary == 0 or max_salary == 0 else f'${min_salary:,} - ${max_salary:,}',
-            'ORIndustry': np.NaN if la_data['Company Industry Name'].values[0] is None else
-            la_data['Company Industry Name'].values[0],
-            'ORIsEmp': True,
-            'ORIsPrimary': la_data['Employment Position Is Primary'].values[0],
-            'ORFullName': la_data['Company Record Standardized Name'].values[0] if
-            la_data['Company Record Standardized Name'].values[0] is not None else
-            la_data['Employment Company Name'].values[
-                0],
-            'ORNotes': np.NaN if la_data['Person Headline'].values[0] is None else la_data['Person Headline'].values[0],
-            'ORPos': np.NaN if la_data['Employment Title'].values[0] is None else la_data['Employment Title'].values[0],
-            'ORProf': np.NaN if la_data['Company Industry Name'].values[0] is None else
-            la_data['Company Industry Name'].values[0],
-            'ORRecip': 'Employee',
-            'ORRelat': 'Employer'
-        }, index=[0])
-
-        # Organisation Data
-        org_df = pd.concat([org_df, re_new], axis=0, ignore_index=True)
-
-        # Prepare Organisation Attributes
-        attributes = sync_org_attributes(la_data, import_id)
-        org_attributes_df = pd.concat([org_attributes_df, attributes], axis=0)
-
-    return org_df, org_attributes_df
-
-
-def sync_org_attributes(data, import_id):
-    # print('\nWorking on Organisation Attributes...\n')
-
-    # Get Sector
-    sector_data = pd.DataFrame()
-
-    sectors = data['Company Details Sector'].values[0]
-
-    if sectors is not None:
-        sectors = sectors.replace(', and ', ', ').replace(', ', ',').split(',')
-
-        for sector in sectors:
-            df = pd.DataFrame(data={
-                'ORAttrORImpID': import_id,
-                'ORAttrImpID': np.NaN,
-                'ORAttrCat': 'Sector',
-                'ORAttrDate': np.NaN,
-                'ORAttrDesc': sector.title(),
-                'ORAttrCom': 'Source: Live Alumni'
-            }, index=[0])
-
-            sector_data = pd.concat([sector_data, df], axis=0, ignore_index=True)
-
-    # Employee Size
-    emp_size_data = pd.DataFrame(data={
-        'ORAttrORImpID': import_id,
-        'ORAttrImpID': np.NaN,
-        'ORAttrCat': 'Employee Size',
-        'ORAttrDate': np.NaN,
-        'ORAttrDesc': data['Company Details Size'].values[0],
-        'ORAttrCom': 'Source: Live Alumni'
-    }, index=[0])
-
-    # Senior Position
-    seniority_data = pd.DataFrame(data={
-        'ORAttrORImpID': import_id,
-        'ORAttrImpID': np.NaN,
-        'ORAttrCat': 'Senior Position',
-        'ORAttrDate': np.NaN,
-        'ORAttrDesc': np.NaN if data['Employment Title Is Senior'].values[0] is None else
-        data['Employment Title Is Senior'].values[0],
-        'ORAttrCom': 'Source: Live Alumni'
-    }, index=[0])
-
-    # Company Type
-    company_type = pd.DataFrame(data={
-        'ORAttrORImpID': import_id,
-        'ORAttrImpID': np.NaN,
-        'ORAttrCat': 'Company Type',
-        'ORAttrDate': np.NaN,
-        'ORAttrDesc': np.NaN if data['Company Type Type'].values[0] is None else data['Company Type Type'].values[0],
-        'ORAttrCom': 'Source: Live Alumni'
-    }, index=[0])
+            match = process.extractOne(
+                query=company,
+                choices=orgs['ORFullName'].drop_duplicates().dropna().tolist(),
+                scorer=fuzz.ratio,
+                score_cutoff=90
+            )
 
-    # Existing Attribute in RE
-    existing_attributes = pd.read_sql_query(
+            # Old
+            if match is not None:
+                decision = orgs[orgs['ORFullName'] == match[0]].head(n=1)['ORImpID'].values[0]
+
+            # New
+            else:
+                decision = 'new'
+
+            employer_matches['entries'][key] = decision
+            employer_matches['new'][key] = decision
+
+        decisions[(company, re_id)] = decision
+
+    return pd.Series([
+        decisions[(company, re_id)] for company, re_id in zip(la_data['Employment Company Name'], la_data['re_id'])
+    ], index=la_data.index, dtype=object)
+
+
+def sync_organisations(mapping, max_org_import_id, employer_matches):
+    # Get Data from Raisers Edge
+    re_data = read_sql(
+        """
+        SELECT
+            "ConsID",
+            "ORFullName",
+            "ORImpID"
+        FROM
+            "Org_Relationships";
+        """
+    )
+
+    # Get every position of the mapped Live Alumni records, derived at load
+    la_data = read_sql(
         f"""
-            SELECT
+        SELECT
             *
         FROM
-            "Org_Relationship_Attributes"
+            la_employment
         WHERE
-            "ORAttrORImpID" = '{import_id}';
-        """,
-        con=client
+            personid IN (
+                SELECT
+                    la_id
+                FROM
+                    re_la_map
+            ) AND
+            personid IN (
+                SELECT
+                    personid
+                FROM
+                    "{CHANGED_PEOPLE}"
+            );
+        """
     )
 
-    existing_attributes['ORAttrDate'] = np.NaN
+    # Attach the RE ID(s) each Live Alumni record is mapped with
+    mapping = mapping.assign(la_id=pd.to_numeric(mapping['la_id'], errors='coerce')).dropna().drop_duplicates()
+
+    la_data = la_data.merge(mapping, left_on='personid', right_on='la_id', how='inner').drop(columns='la_id')
+
+    # Primary and current positions first, then the most recent ones, as ranked at load
+    la_data = la_data.sort_values(by=['re_id', 'personid', 'position_rank'], ignore_index=True)
+
+    org_df = build_employment(la_data)
 
-    new_attributes = pd.concat([existing_attributes, seniority_data, sector_data, emp_size_data, company_type],
-                               axis=0, ignore_index=True)
+    # Version of the organisation list of every constituent to match, once for all of their companies
+    org_list_versions = {
+        cons_id: get_org_list_version(orgs)
+        for cons_id, orgs in re_data[re_data['ConsID'].isin(la_data['re_id'])].groupby('ConsID')
+    }
+
+    # Check if organisation is new/old
+    decisions = match_employers(la_data, re_data, employer_matches, org_list_versions)
+    is_new = decisions == 'new'
+
+    # New organisations get the next import IDs, existing ones are updated
+    new_ids = pd.Series(max_org_import_id + np.arange(is_new.sum()), index=decisions[is_new].index)
+
+    org_df['ORImpID'] = decisions.where(~is_new, new_ids.map(lambda x: format_import_id(int(x))))
+
+    return org_df, la_data
+
+
+def sync_org_attributes(la_data, import_ids):
+    # Attribute values of every employment row, one column per category
+    values = pd.DataFrame(data={
+        'row': np.arange(la_data.shape[0]),
+        'ORAttrORImpID': import_ids.values,
+        'Senior Position': la_data['Employment Title Is Senior'].values,
+        'Sector': la_data['Company Details Sector'].str.replace(', and ', ', ', regex=False).str.replace(
+            ', ', ',', regex=False).str.split(',').values,
+        'Employee Size': la_data['Company Details Size'].values,
+        'Company Type': la_data['Company Type Type'].values
+    })
+
+    # One row per attribute, with one row per sector of multi-sector companies, grouped by employment row
+    new_attributes = values.melt(
+        id_vars=['row', 'ORAttrORImpID'], var_name='ORAttrCat', value_name='ORAttrDesc'
+    ).explode('ORAttrDesc', ignore_index=True).dropna(subset=['ORAttrDesc'])
+
+    new_attributes = new_attributes.sort_values(by='row', kind='stable', ignore_index=True)
+
+    new_attributes['ORAttrDesc'] = new_attributes['ORAttrDesc'].astype(str)
 
-    # Dropping rows with no data
-    new_attributes.dropna(subset=['ORAttrDesc'], inplace=True, ignore_index=True)
+    is_sector = new_attributes['ORAttrCat'] == 'Sector'
+    new_attributes.loc[is_sector, 'ORAttrDesc'] = new_attributes.loc[is_sector, 'ORAttrDesc'].str.title()
+
+    new_attributes = new_attributes.assign(
+        ORAttrImpID=np.nan, ORAttrDate=np.nan, ORAttrCom='Source: Live Alumni'
+    )[['ORAttrORImpID', 'ORAttrImpID', 'ORAttrCat', 'ORAttrDate', 'ORAttrDesc', 'ORAttrCom']]
+
+    # Existing Attribute in RE
+    existing_attributes = read_sql(
+        """
+        SELECT
+            "ORAttrImpID",
+            "ORAttrORImpID",
+            "ORAttrCat",
+            "ORAttrDate",
+            "ORAttrDesc",
+            "ORAttrCom"
+        FROM
+            "Org_Relationship_Attributes";
+        """
+    )
+
+    existing_attributes = existing_attributes[
+        existing_attributes['ORAttrORImpID'].isin(new_attributes['ORAttrORImpID'])
+    ].assign(ORAttrDate=np.nan)
+
+    new_attributes = pd.concat([existing_attributes, new_attributes], axis=0, ignore_index=True)
 
     # Dropping duplicate or existing values
-    new_attributes.drop_duplicates(subset=['ORAttrCat', 'ORAttrDesc'], inplace=True, ignore_index=True)
+    new_attributes.drop_duplicates(subset=['ORAttrORImpID', 'ORAttrCat', 'ORAttrDesc'], inplace=True,
+                                   ignore_index=True)
     new_attributes = new_attributes[new_attributes['ORAttrImpID'].isnull()].reset_index(drop=True).copy()
 
     return new_attributes
 
 
+# Print a few rows of a frame, the same ones on every run, or all of them when there are fewer
+def print_preview(df):
+    sample = df.fillna('').sample(n=min(10, df.shape[0]), random_state=0)
+
+    print(tabulate(sample, headers='keys', tablefmt='pretty', showindex=False, missingval=''))
+
+
 def export_to_csv(df, filename):
     print(f'\nExporting data to {filename}...\n')
-    df.to_csv(f'Final/{filename}', quoting=1, lineterminator='\r\n', index=False)
+    df.to_csv(os.path.join(OUTPUT_DIR, filename), quoting=1, lineterminator='\r\n', index=False)
 
 
 def format_import_id(import_id):
     return str(import_id)[0:5] + '-' + str(import_id)[5:8] + '-' + str(import_id)[-10:]
 
 
-def format_org_attributes():
+def format_org_attributes(org_attributes, max_org_attribute_imp_id):
     # Adding Import IDs for Organisation Attributes
     org_attributes['ORAttrImpID'] = np.arange(int(max_org_attribute_imp_id),
                                               int(max_org_attribute_imp_id) + org_attributes.shape[0])
@@ -277,135 +618,171 @@ def format_org_attributes():
     # Adding Dates
     org_attributes['ORAttrDate'] = pd.to_datetime('today').strftime('%d-%b-%Y')
 
+    return org_attributes
+
 
 def get_import_ids(id_name):
     match id_name:
 
         case 'max_org_import_id':
-            max_id = pd.read_sql_query(
+            max_id = read_sql(
                 """
                     SELECT
-                        REPLACE("ORImpID", '-', '') AS id
+                        MAX("ORImpID_num") AS id
                     FROM
-                        "Org_Relationships"
-                    ORDER BY
-                        id DESC
-                    LIMIT 1; 
-                    """,
-                con=client
-            )['id'].astype(float).values[0] + 9999999999
+                        "Org_Relationships";
+                    """
+            )['id'].values[0] + 9999999999
 
         case 'max_org_attribute_imp_id':
-            max_id = pd.read_sql_query(
+            max_id = read_sql(
                 """
                     SELECT
-                        REPLACE("ORAttrImpID", '-', '') AS id
+                        MAX("ORAttrImpID_num") AS id
                     FROM
-                        "Org_Relationship_Attributes"
-                    ORDER BY
-                        id DESC
-                    LIMIT 1;
-                    """,
-                con=client
-            )['id'].astype(float).values[0] + 9999999999
+                        "Org_Relationship_Attributes";
+                    """
+            )['id'].values[0] + 9999999999
 
         case 'max_address_imp_id':
-            max_id = pd.read_sql_query(
+            max_id = read_sql(
                 """
                     SELECT
-                        REPLACE("AddrImpID", '-', '') AS id
+                        MAX("AddrImpID_num") AS id
                     FROM
-                        "Addresses"
-                    ORDER BY
-                        id DESC
-                    LIMIT 1;
-                    """,
-                con=client
-            )['id'].astype(float).values[0] + 9999999999
+                        "Addresses";
+                    """
+            )['id'].values[0] + 9999999999
 
         case 'max_phone_import_id':
-            max_id = pd.read_sql_query(
+            max_id = read_sql(
                 """
                     SELECT
-                        REPLACE("PhoneImpID", '-', '') AS id
+                        MAX("PhoneImpID_num") AS id
                     FROM
-                        "Phone_List"
-                    ORDER BY
-                        id DESC
-                    LIMIT 1;
-                    """,
-                con=client
-            )['id'].astype(float).values[0] + 9999999999
+                        "Phone_List";
+                    """
+            )['id'].values[0] + 9999999999
 
         case 'max_attribute_import_id':
-            max_id = pd.read_sql_query(
+            max_id = read_sql(
                 """
                     SELECT
-                        REPLACE("CAttrImpID", '-', '') AS id
+                        MAX("CAttrImpID_num") AS id
                     FROM
-                        "Custom_Fields"
-                    ORDER BY
-                        id DESC
-                    LIMIT 1;
-                    """,
-                con=client
-            )['id'].astype(float).values[0] + 9999999999
+                        "Custom_Fields";
+                    """
+            )['id'].values[0] + 9999999999
 
         case _:
             max_id = random.randint(1000000000, 9999999999)
 
-    return int(max_id)
+    return lease_import_ids(id_name, int(max_id))
+
+
+# Reserve a block of IMPORT_ID_BLOCK import IDs for the workspace, past the blocks of every other workspace, so that
+# runs on the same RE export never hand out the same IDs. A workspace keeps its block across reruns.
+def lease_import_ids(id_name, first_id):
+    owner = get_workspace() or 'default'
+    now = pd.Timestamp.now().isoformat(timespec='seconds')
+    expiry = (pd.Timestamp.now() - pd.Timedelta(days=int(os.getenv('IMPORT_ID_LEASE_DAYS', '30')))).isoformat(
+        timespec='seconds')
+
+    conn = connect_to_state()
+
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS import_id_leases (
+            owner TEXT NOT NULL,
+            id_name TEXT NOT NULL,
+            start_id INTEGER NOT NULL,
+            end_id INTEGER NOT NULL,
+            leased_at TEXT NOT NULL,
+            PRIMARY KEY (owner, id_name)
+        );
+        """
+    )
+
+    # Taking the write lock up front, so that concurrent runs lease one after the other
+    conn.execute('BEGIN IMMEDIATE;')
+
+    try:
+        conn.execute('DELETE FROM import_id_leases WHERE leased_at < ?;', (expiry,))
+
+        lease = conn.execute(
+            'SELECT start_id FROM import_id_leases WHERE owner = ? AND id_name = ? AND start_id >= ?;',
+            (owner, id_name, first_id)
+        ).fetchone()
+
+        if lease is not None:
+            start_id = lease[0]
+
+        else:
+            taken = conn.execute(
+                'SELECT MAX(end_id) FROM import_id_leases WHERE owner != ? AND id_name = ?;', (owner, id_name)
+            ).fetchone()[0]
+
+            start_id = max(first_id, taken or 0)
+
+        conn.execute(
+            'INSERT OR REPLACE INTO import_id_leases VALUES (?, ?, ?, ?, ?);',
+            (owner, id_name, start_id, start_id + IMPORT_ID_BLOCK, now)
+        )
+
+        conn.commit()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+    return start_id
 
 
 def sync_linkedin():
     # Get missing LinkedIn URLs in RE
-    linkedin = pd.read_sql_query(
-        """
-        WITH la_ids as (
+    chunks = read_sql_chunks(
+        f"""
+        SELECT
+            DISTINCT
+            REPLACE("Person URL", 'https://www.', '') AS phone,
+            personid AS la_id,
+            re_id
+        FROM
+            "Live_Alumni" AS la
+            RIGHT JOIN re_la_map AS m ON la.personid = m.la_id
+        WHERE
+            m.la_id IN (SELECT personid FROM "{CHANGED_PEOPLE}") AND
+            REPLACE("Person URL", 'https://www.', '') NOT IN (
                 SELECT
-                    DISTINCT
-                    CAST("ConsID" AS INT) AS re_id,
-                    CAST("CAttrDesc" AS INT) AS la_id
-                FROM
-                    "Custom_Fields"
-                WHERE
-                    "CAttrCat" = 'Live Alumni ID'
-            )
-    
-            SELECT
-                    DISTINCT
-                    REPLACE("Person URL", 'https://www.', '') AS phone,
-                    personid AS la_id,
-                    re_id
+                    CASE
+                        WHEN RIGHT("PhoneNum",1) = '/'
+                            THEN LEFT(REPLACE(REPLACE(REPLACE("PhoneNum", 'https://www.', ''), 
+                            'http://www', ''), 'www.', ''),
+                                    LENGTH(REPLACE(REPLACE(REPLACE("PhoneNum", 'https://www.', ''), 
+                                    'http://www', ''), 'www.', '')) - 1)
+                        ELSE
+                            REPLACE(REPLACE(REPLACE("PhoneNum", 'https://www.', ''), 
+                            'http://www', ''), 'www.', '')
+                    END
                 FROM
-                    "Live_Alumni" AS la
-                    RIGHT JOIN la_ids ON la.personid = la_ids.la_id
+                    "Phone_List"
                 WHERE
-                    REPLACE("Person URL", 'https://www.', '') NOT IN (
-                        SELECT
-                            CASE
-                                WHEN RIGHT("PhoneNum",1) = '/'
-                                    THEN LEFT(REPLACE(REPLACE(REPLACE("PhoneNum", 'https://www.', ''), 
-                                    'http://www', ''), 'www.', ''),
-                                            LENGTH(REPLACE(REPLACE(REPLACE("PhoneNum", 'https://www.', ''), 
-                                            'http://www', ''), 'www.', '')) - 1)
-                                ELSE
-                                    REPLACE(REPLACE(REPLACE("PhoneNum", 'https://www.', ''), 
-                                    'http://www', ''), 'www.', '')
-                            END
-                        FROM
-                            "Phone_List"
-                        WHERE
-                            "PhoneType" LIKE 'LinkedIn%%'
-                        );
-        """,
-        con=client
+                    "PhoneType" LIKE 'LinkedIn%%'
+            );
+        """
     )
 
+    # The query already leaves out the URLs in RE, so every chunk is part of the result. Streaming only bounds what is
+    # fetched at a time, not the size of the result.
+    linkedin = pd.concat(chunks, axis=0, ignore_index=True).sort_values(by=['re_id', 'phone'], ignore_index=True)
+
     # Reformat to the way RE needs
     df = pd.DataFrame(data={
-        'PhoneType': np.NaN,
-        'PhoneImpID': np.NaN,
+        'PhoneType': np.nan,
+        'PhoneImpID': np.nan,
         'ConsID': linkedin['re_id'].values,
         'PhoneIsInactive': False,
         'PhoneIsPrimary': False,
@@ -458,7 +835,7 @@ def get_phone_id(phone_df, phone_type):
 
                 # Query database when we don't know the max id
                 if i == 0:
-                    new_id = pd.read_sql_query(
+                    new_id = read_sql(
                         f"""
                         SELECT COALESCE(
                             (SELECT
@@ -478,8 +855,7 @@ def get_phone_id(phone_df, phone_type):
                             LIMIT 1),
                             1
                         ) AS phone_id;
-                        """,
-                        con=client
+                        """
                     ).values[0][0]
                     phone_ids.append(f'{phone_type} {new_id}')
 
@@ -490,35 +866,10 @@ def get_phone_id(phone_df, phone_type):
     return phone_ids
 
 
-def sync_email():
-    # Get data from Live Alumni
-    la_emails = pd.read_sql_query(
-        """
-        WITH la_ids as (
-            SELECT
-                DISTINCT
-                CAST("ConsID" AS INT) AS re_id,
-                CAST("CAttrDesc" AS INT) AS la_id
-            FROM
-                "Custom_Fields"
-            WHERE
-                "CAttrCat" = 'Live Alumni ID'
-        )
-
-        SELECT
-            DISTINCT
-            LOWER("Contact Data Business Email") AS email_1,
-            LOWER("Person Email") AS email_2,
-            personid
-        FROM
-            "Live_Alumni" AS la
-            RIGHT JOIN la_ids ON la.personid = la_ids.la_id
-        WHERE
-            "Contact Data Business Email" IS NOT NULL OR
-            "Person Email" IS NOT NULL;
-        """,
-        con=client
-    )
+def explode_emails(la_emails):
+    # Nothing to split in an empty chunk
+    if la_emails.empty:
+        return pd.DataFrame(columns=['personid', 'email'])
 
     # Get count of semicolons
     email_1 = la_emails['email_1'].str.replace(
@@ -533,7 +884,7 @@ def sync_email():
                    int(count) + 2):  # Adding 1 since the count of values would exceed by 1 than the delimiter count,
         # another 1 for the range
         n = c + 2
-        la_emails[f'email_{n}'] = np.NaN
+        la_emails[f'email_{n}'] = np.nan
 
     # Create an empty placeholder dataframe
     email_ = pd.DataFrame()
@@ -570,8 +921,12 @@ def sync_email():
     # Dropping email type column
     la_emails.drop(columns=['email_type'], inplace=True)
 
+    return la_emails
+
+
+def sync_email():
     # Get data from RE
-    re_emails = pd.read_sql_query(
+    re_emails = read_sql(
         """
         SELECT
             DISTINCT "PhoneNum" AS email
@@ -579,27 +934,53 @@ def sync_email():
             "Phone_List"
         WHERE
             "PhoneType" LIKE 'Email%%';
-        """,
-        con=client
+        """
     )
 
-    # Get the missing email addresses not present in RE
-    missing_emails = la_emails[~la_emails['email'].isin(re_emails['email'])]
+    missing_emails = []
+
+    # Get data from Live Alumni
+    for la_emails in read_sql_chunks(
+        f"""
+        SELECT
+            DISTINCT
+            LOWER("Contact Data Business Email") AS email_1,
+            LOWER("Person Email") AS email_2,
+            personid
+        FROM
+            "Live_Alumni" AS la
+            RIGHT JOIN re_la_map AS m ON la.personid = m.la_id
+        WHERE
+            m.la_id IN (SELECT personid FROM "{CHANGED_PEOPLE}") AND (
+                "Contact Data Business Email" IS NOT NULL OR
+                "Person Email" IS NOT NULL
+            );
+        """
+    ):
+        la_emails = explode_emails(la_emails)
+
+        # Get the missing email addresses not present in RE
+        missing_emails.append(la_emails[~la_emails['email'].isin(re_emails['email'])])
+
+    # The same address can come from rows of a person in different chunks. Sorting keeps the output independent of
+    # how the rows were chunked.
+    missing_emails = pd.concat(missing_emails, axis=0, ignore_index=True).drop_duplicates().sort_values(
+        by=['personid', 'email'], ignore_index=True)
 
     # Get RE IDs of the above missing email address
-    missing_emails_with_id = pd.read_sql_query(
+    personids = ', '.join(str(int(x)) for x in missing_emails['personid'].drop_duplicates())
+
+    missing_emails_with_id = read_sql(
         f"""
         SELECT
             DISTINCT
-            CAST("ConsID" AS INT) AS re_id,
-            CAST("CAttrDesc" AS INT) AS personid
+            re_id,
+            la_id AS personid
         FROM
-            "Custom_Fields"
+            re_la_map
         WHERE
-            "CAttrCat" = 'Live Alumni ID' AND
-            CAST("CAttrDesc" AS INT) IN {tuple(missing_emails['personid'].tolist())};
-        """,
-        con=client
+            la_id IN ({personids or 'NULL'});
+        """
     )
 
     # Get records with missing email ID and live alumni linked in RE
@@ -610,8 +991,8 @@ def sync_email():
 
     # Reformat to the way RE needs
     df = pd.DataFrame(data={
-        'PhoneType': np.NaN,
-        'PhoneImpID': np.NaN,
+        'PhoneType': np.nan,
+        'PhoneImpID': np.nan,
         'ConsID': missing_emails['re_id'].values,
         'PhoneIsInactive': False,
         'PhoneIsPrimary': False,
@@ -630,21 +1011,21 @@ def sync_email():
 
     # Verified Emails
     df_1 = pd.DataFrame(data={
-        'CAttrImpID': np.NaN,
+        'CAttrImpID': np.nan,
         'CAttrCat': 'Verified Email',
         'CAttrCom': 'Live Alumni',
         'ConsID': missing_emails['re_id'].values,
-        'CAttrDate': np.NaN,
+        'CAttrDate': np.nan,
         'CAttrDesc': missing_emails['email'].values
     })
 
     # Sync Source
     df_2 = pd.DataFrame(data={
-        'CAttrImpID': np.NaN,
+        'CAttrImpID': np.nan,
         'CAttrCat': 'Sync source',
         'CAttrCom': missing_emails['email'].values,
         'ConsID': missing_emails['re_id'].values,
-        'CAttrDate': np.NaN,
+        'CAttrDate': np.nan,
         'CAttrDesc': 'Live Alumni | Email'
     })
 
@@ -671,26 +1052,16 @@ def split_emails(email1, email2, df):
 
     # If the difference is positive, append NaN values to email
     if diff > 0:
-        email.extend([np.NaN] * diff)
+        email.extend([np.nan] * diff)
 
     return email
 
 
-def sync_address():
+def sync_address(max_address_imp_id):
     # Get new addresses
-    new_addresses = pd.read_sql_query(
-        """
-        WITH la_ids AS (
-                SELECT
-                    DISTINCT
-                    CAST("ConsID" AS INT) AS re_id,
-                    CAST("CAttrDesc" AS INT) AS la_id
-                FROM
-                    "Custom_Fields"
-                WHERE
-                    "CAttrCat" = 'Live Alumni ID'
-            ),
-            address_data AS (
+    chunks = read_sql_chunks(
+        f"""
+        WITH address_data AS (
                 SELECT
                     DISTINCT
                     personid AS la_id,
@@ -709,10 +1080,11 @@ def sync_address():
                     "AddrCountry" AS re_country
                 FROM
                     "Live_Alumni" AS la
-                    JOIN la_ids ON la.personid = la_ids.la_id
+                    JOIN re_la_map AS m ON la.personid = m.la_id
                     JOIN "Country_Mapping" c ON la."Location Country" = c."Country in Live Alumni"
                     JOIN "Addresses" a ON a."ConsID" = re_id
                 WHERE
+                    m.la_id IN (SELECT personid FROM "{CHANGED_PEOPLE}") AND
                     a."PrefAddr" = TRUE
             )
 
@@ -727,11 +1099,12 @@ def sync_address():
             la_city != re_city OR
             la_state != re_state OR
             la_country != re_country;
-        """,
-        con=client
+        """
     )
 
-    max_address_imp_id = get_import_ids('max_address_imp_id')
+    # The query already leaves out the unchanged addresses, so every chunk is part of the result. Streaming only bounds
+    # what is fetched at a time, not the size of the result.
+    new_addresses = pd.concat(chunks, axis=0, ignore_index=True).sort_values(by=['re_id', 'city'], ignore_index=True)
 
     # Create Address Dataframe
     df = pd.DataFrame(data={
@@ -747,156 +1120,350 @@ def sync_address():
 
     #  Verified Locations
     df_1 = pd.DataFrame(data={
-        'CAttrImpID': np.NaN,
+        'CAttrImpID': np.nan,
         'CAttrCat': 'Verified Location',
         'CAttrCom': 'Live Alumni',
         'ConsID': new_addresses['re_id'].values,
-        'CAttrDate': np.NaN,
+        'CAttrDate': np.nan,
         'CAttrDesc': new_addresses['city'].str.cat(new_addresses[['state', 'country']], sep=', ')
     })
 
     # Sync Source
     df_2 = pd.DataFrame(data={
-        'CAttrImpID': np.NaN,
+        'CAttrImpID': np.nan,
         'CAttrCat': 'Sync source',
         'CAttrCom': new_addresses['city'].str.cat(new_addresses[['state', 'country']], sep=', '),
         'ConsID': new_addresses['re_id'].values,
-        'CAttrDate': np.NaN,
+        'CAttrDate': np.nan,
         'CAttrDesc': 'Live Alumni | Location'
     })
 
     return df, df_1, df_2
 
 
-try:
-    client = connect_to_db()
+########################################################################################################################
+#                                                 Change Detection                                                     #
+########################################################################################################################
+
+# Live Alumni fields read by each stage. A person is processed again by a stage only once one of them changes.
+CHANGE_FIELDS = {
+    'Organisations': [
+        'Personal Industry Name', 'Employment Company Name', 'Employment Title', 'Employment Start Year',
+        'Employment Start Month', 'Employment End Year', 'Employment End Month', 'Company Industry Name',
+        'Employment Position Is Current', 'Employment Position Is Primary', 'Employment Title Is Senior',
+        'Employment Salary Min', 'Employment Salary Max', 'Employment Seniority Level',
+        'Company Record Standardized Name', 'Company Record Historic Head Count', 'Company Record Current Head Count',
+        'Company Type Type', 'Company Details Size', 'Company Details Sector', 'Company Details Website',
+        'Person Headline'
+    ],
+    'LinkedIn': ['Person URL'],
+    'Emails': ['Contact Data Business Email', 'Person Email'],
+    'Addresses': ['Location City', 'Location State/Province', 'Location Country']
+}
+
+
+# Hash of every mapped person, or of every sampled one on a sample run, for each stage, over the RE IDs it is mapped to
+# and all its rows of the stage fields
+def get_person_hashes():
+    hashes = []
+
+    for stage, fields in CHANGE_FIELDS.items():
+        row = "CONCAT_WS(CHR(31), " + ', '.join(f'COALESCE(CAST("{field}" AS TEXT), \'\')' for field in fields) + ")"
+
+        hashes.append(
+            f"""
+            MD5(
+                STRING_AGG(DISTINCT CAST(re_id AS TEXT), ',' ORDER BY CAST(re_id AS TEXT)) || '|' ||
+                STRING_AGG(DISTINCT {row}, CHR(30) ORDER BY {row})
+            ) AS "{stage}"
+            """
+        )
 
-    ####################################################################################################################
-    #                                                    1. MAPPING                                                    #
-    ####################################################################################################################
+    return read_sql(
+        f"""
+        SELECT
+            personid,
+            {', '.join(hashes)}
+        FROM
+            "Live_Alumni" AS la
+            JOIN re_la_map AS m ON la.personid = m.la_id
+        {f'WHERE personid IN (SELECT personid FROM "{SAMPLED_PEOPLE}")' if SAMPLE_SIZE else ''}
+        GROUP BY
+            personid;
+        """
+    )
 
-    # Mapping RE ID with Live Alumni ID
-    print('\nMapping RE ID with respective Live Alumni ID... \n')
-    mapping = pd.read_sql_query(
+
+# Snapshots are kept per workspace, as each holds its own exports and runs. The default one is ''.
+def initialize_person_snapshots(conn):
+    # Snapshots taken before they were kept per workspace can't be told apart, so everyone is processed once more
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(person_snapshots);')]
+
+    if columns and 'workspace' not in columns:
+        conn.execute('DROP TABLE person_snapshots;')
+
+    conn.execute(
         """
+        CREATE TABLE IF NOT EXISTS person_snapshots (
+            workspace TEXT NOT NULL,
+            personid INTEGER NOT NULL,
+            stage TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (workspace, personid, stage)
+        );
+        """
+    )
+
+
+# The same SAMPLE_SIZE mapped alumni on every run: those with the lowest hash of their Live Alumni ID, which doesn't
+# depend on the order of the rows or on who else is in the upload. Picked in SQL, so that the rest are never read.
+def sample_people():
+    return read_sql(
+        f"""
         SELECT
-            "ConsID" AS re_id,
-            "CAttrDesc" AS la_id
+            la_id AS personid
         FROM
-            "Custom_Fields"
-        WHERE
-            "CAttrCat" = 'Live Alumni ID';
-        """,
-        con=client
+            (
+                SELECT
+                    DISTINCT la_id
+                FROM
+                    re_la_map
+                WHERE
+                    la_id IN (SELECT personid FROM "Live_Alumni")
+            ) AS mapped
+        ORDER BY
+            MD5(CAST(la_id AS TEXT)),
+            la_id
+        LIMIT {SAMPLE_SIZE};
+        """
     )
 
-    re_ids_to_sync = mapping['re_id'].drop_duplicates().to_list()
 
-    ####################################################################################################################
-    #                                                2. Create Empty Dataframes                                        #
-    ####################################################################################################################
+# People whose stage fields changed since the last successful run in the workspace, for each stage. Everyone on a full
+# refresh, and every sampled person on a sample run.
+def get_changed_people(person_hashes):
+    if env_flag('FULL_REFRESH') or SAMPLE_SIZE:
+        return {stage: person_hashes[['personid']] for stage in CHANGE_FIELDS}
 
-    # 1. Organisation
-    org = pd.DataFrame()
-    org_attributes = pd.DataFrame()
+    conn = connect_to_state()
+    initialize_person_snapshots(conn)
 
-    # # 2. Phone
-    # phone = pd.DataFrame()
-    # phone_attributes = pd.DataFrame()
+    snapshots = pd.read_sql_query(
+        'SELECT personid, stage, hash FROM person_snapshots WHERE workspace = ?;', con=conn,
+        params=(get_workspace() or '',)
+    )
 
-    # Get Import IDs
-    max_org_import_id = get_import_ids('max_org_import_id')
-    max_org_attribute_imp_id = get_import_ids('max_org_attribute_imp_id')
+    conn.close()
 
-    ####################################################################################################################
-    #                                          3. Looping each record for comparison                                   #
-    ####################################################################################################################
+    changed_people = {}
 
-    # Looping through each RE ID
-    for re_id in re_ids_to_sync:
+    for stage in CHANGE_FIELDS:
+        previous = snapshots[snapshots['stage'] == stage][['personid', 'hash']]
+        current = person_hashes[['personid', stage]].merge(previous, on='personid', how='left')
 
-        # Get corresponding Live Alumni ID(s)
-        live_alumni_ids = mapping[mapping['re_id'] == re_id]['la_id'].drop_duplicates().to_list()
+        changed_people[stage] = current[current[stage] != current['hash']][['personid']].reset_index(drop=True)
 
-        print('Working on Organisations...\n')
+    return changed_people
 
-        for la_id in live_alumni_ids:
-            # print('_______________________________________________________________________\n')
-            # print(f'Working on record with Raisers Edge ID: {re_id}')
-            # print(f'The Live Alumni ID mapped with this record is: {la_id}')
-            # print('_______________________________________________________________________\n')
 
-            ############################################################################################################
-            #                                           3.1 Organisations                                              #
-            ############################################################################################################
+# Only called once a run completed, so that a failed run is fully retried by the next one
+def save_person_snapshots(person_hashes):
+    now = pd.Timestamp.now().isoformat(timespec='seconds')
 
-            # Organisations
-            org_data, org_data_attributes = sync_organisations()
+    workspace = get_workspace() or ''
+    snapshots = person_hashes.melt(id_vars='personid', var_name='stage', value_name='hash')
 
-            org = pd.concat([org, org_data], axis=0, ignore_index=True)
-            org_attributes = pd.concat([org_attributes, org_data_attributes], axis=0, ignore_index=True)
+    conn = connect_to_state()
+    initialize_person_snapshots(conn)
+
+    with conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO person_snapshots VALUES (?, ?, ?, ?, ?);',
+            [
+                (workspace, int(personid), stage, hash_, now)
+                for personid, stage, hash_ in snapshots.itertuples(index=False)
+            ]
+        )
 
-            # Generate Import IDs
-            max_org_import_id += 1
-            max_org_attribute_imp_id += 1
+    conn.close()
+
+
+########################################################################################################################
+#                                                    Checkpoints                                                       #
+########################################################################################################################
+
+# Fingerprint of the given columns of a table, over all its rows in any order
+def get_table_fingerprint(table, columns):
+    key = (table, tuple(columns))
+
+    if key not in table_fingerprints:
+        row = "CONCAT_WS(CHR(31), " + ', '.join(f'COALESCE(CAST("{col}" AS TEXT), \'\')' for col in columns) + ")"
+
+        # Summing row hashes doesn't need the rows sorted
+        if get_backend() == 'duckdb':
+            row_hash = f'HASH({row})'
+
+        else:
+            row_hash = f"('x' || LEFT(MD5({row}), 15))::BIT(60)::BIGINT"
+
+        fingerprint = run_query(
+            client, f'SELECT COUNT(*) AS n, CAST(SUM({row_hash}) AS TEXT) AS h FROM "{table}";'
+        ).iloc[0]
+
+        table_fingerprints[key] = f"{fingerprint['n']}:{fingerprint['h']}"
+
+    return table_fingerprints[key]
+
+
+# Fingerprint of the code, of the table columns the stage declares in STAGE_INPUTS, and of the other inputs it is given
+def get_stage_fingerprint(name, inputs):
+    fingerprint = hashlib.sha1(f'{CODE_VERSION}:{name}'.encode())
+
+    for table, columns in sorted(STAGE_INPUTS[name].items()):
+        fingerprint.update(f'{table}={get_table_fingerprint(table, columns)}'.encode())
+
+    for key, value in sorted(inputs.items()):
+        if isinstance(value, pd.DataFrame):
+            value = pd.util.hash_pandas_object(value.astype(str), index=False).sum()
+
+        fingerprint.update(f'{key}={value}'.encode())
+
+    return fingerprint.hexdigest()
+
+
+def save_checkpoint(name, fingerprint, outputs, high_water_marks):
+    try:
+        save_result(name, fingerprint, outputs, high_water_marks)
+
+    # A stage that can't be checkpointed is simply recomputed next time
+    except Exception as e:
+        print(f'Unable to checkpoint {name}: {e}\n')
+
+
+# Run a stage, or reuse its checkpoint when none of its inputs changed since it last completed. Sample runs always run
+# their stages, as fingerprinting the tables would read them in full.
+def run_stage(name, func, inputs, high_water_marks=None):
+    high_water_marks = high_water_marks or {}
+
+    if SAMPLE_SIZE:
+        with track_stage(name) as stage:
+            outputs = func(**inputs, **high_water_marks)
+
+            stage['rows_out'] = sum(df.shape[0] for df in outputs.values())
+
+        return outputs
+
+    fingerprint = get_stage_fingerprint(name, {**inputs, **high_water_marks})
+
+    if not env_flag('FULL_REFRESH'):
+        outputs = load_result(fingerprint)
+
+        if outputs is not None:
+            print(f'Reusing the checkpoint of {name}...\n')
+            return outputs
+
+    with track_stage(name) as stage:
+        outputs = func(**inputs, **high_water_marks)
+
+        stage['rows_out'] = sum(df.shape[0] for df in outputs.values())
+
+    save_checkpoint(name, fingerprint, outputs, high_water_marks)
+
+    return outputs
+
+
+########################################################################################################################
+#                                                      Stages                                                          #
+########################################################################################################################
+
+def map_records():
+    # Mapping RE ID with Live Alumni ID
+    mapping = read_sql(
+        f"""
+        SELECT
+            re_id,
+            la_id
+        FROM
+            re_la_map
+        {f'WHERE la_id IN (SELECT personid FROM "{SAMPLED_PEOPLE}")' if SAMPLE_SIZE else ''};
+        """
+    )
+
+    return {'mapping': mapping}
+
+
+def process_organisations(mapping, changed_people, max_org_import_id, max_org_attribute_imp_id):
+    write_table(client, CHANGED_PEOPLE, changed_people)
+
+    # Decisions of earlier runs
+    employer_matches = load_employer_matches()
+
+    # 1. Organisation
+    org, la_data = sync_organisations(mapping, max_org_import_id, employer_matches)
+
+    # Organisation Attributes
+    org_attributes = sync_org_attributes(la_data, org['ORImpID'])
+
+    save_employer_matches(employer_matches)
 
     # Formatting the Organisation Attributes
-    format_org_attributes()
+    org_attributes = format_org_attributes(org_attributes, max_org_attribute_imp_id)
 
     # Sync Source
     new_organisations = pd.DataFrame(data={
-        'CAttrImpID': np.NaN,
+        'CAttrImpID': np.nan,
         'CAttrCat': 'Sync Source',
         'CAttrCom': org['ORFullName'].values,
         'ConsID': org['ConsID'].values,
-        'CAttrDate': np.NaN,
+        'CAttrDate': np.nan,
         'CAttrDesc': 'Live Alumni | Employment'
     })
 
-    ####################################################################################################################
-    #                                                  4. LinkedIn                                                     #
-    ####################################################################################################################
+    return {'org': org, 'org_attributes': org_attributes, 'new_organisations': new_organisations}
 
-    print('Working on LinkedIn URLs...\n')
-    linkedin_data = sync_linkedin()
 
-    ####################################################################################################################
-    #                                                  5. Emails                                                       #
-    ####################################################################################################################
+def process_linkedin(changed_people):
+    write_table(client, CHANGED_PEOPLE, changed_people)
+
+    return {'linkedin_data': sync_linkedin()}
+
+
+def process_emails(linkedin_data, changed_people, max_phone_import_id):
+    write_table(client, CHANGED_PEOPLE, changed_people)
 
-    print('Working on Email addresses...\n')
     email_data, verified_email, new_emails = sync_email()
 
     # All Phones combined
     phone_data = pd.concat([linkedin_data, email_data], axis=0, ignore_index=True)
 
     # Phones Import ID
-    max_phone_import_id = get_import_ids('max_phone_import_id')
     phone_data['PhoneImpID'] = np.arange(max_phone_import_id, max_phone_import_id + phone_data.shape[0])
 
     phone_data['PhoneImpID'] = phone_data['PhoneImpID'].apply(lambda x: format_import_id(x))
 
-    ####################################################################################################################
-    #                                                  6. Addresses                                                    #
-    ####################################################################################################################
+    return {'phone_data': phone_data, 'verified_email': verified_email, 'new_emails': new_emails}
+
+
+def process_addresses(changed_people, max_address_imp_id):
+    write_table(client, CHANGED_PEOPLE, changed_people)
 
-    print('Working on Addresses...\n')
-    address, verified_address, new_address = sync_address()
+    address, verified_address, new_address = sync_address(max_address_imp_id)
 
     # Format Address Import ID
     address['AddrImpID'] = address['AddrImpID'].apply(lambda x: format_import_id(x))
 
-    ####################################################################################################################
-    #                                               7. Custom Fields                                                   #
-    ####################################################################################################################
+    return {'address': address, 'verified_address': verified_address, 'new_address': new_address}
 
+
+def process_custom_fields(verified_email, new_emails, verified_address, new_address, new_organisations,
+                          max_attribute_import_id):
     # Format Attributes
     custom_fields = pd.concat([
         verified_email, new_emails, verified_address, new_address, new_organisations
     ], axis=0, ignore_index=True)
 
     # Format Attributes Import ID
-    max_attribute_import_id = get_import_ids('max_attribute_import_id')
     custom_fields['CAttrImpID'] = np.arange(max_attribute_import_id, max_attribute_import_id + custom_fields.shape[0])
 
     custom_fields['CAttrImpID'] = custom_fields['CAttrImpID'].apply(lambda x: format_import_id(x))
@@ -905,39 +1472,279 @@ try:
     custom_fields['CAttrDate'] = pd.to_datetime('today').strftime('%d-%b-%Y')
 
     # Ensuring Custom Field comments are less than 50 characters
-    custom_fields['custom_fields'] = custom_fields['custom_fields'].str[:50]
-
-    ####################################################################################################################
-    #                                                 Final Data                                                       #
-    ####################################################################################################################
-
-    print('\nFinal Data of Organisations:\n')
-    print(tabulate(org.fillna('').sample(n=10), headers='keys', tablefmt='pretty', showindex=False, missingval=''))
-
-    print('\nFinal Data of Organisation Attributes:\n')
-    print(tabulate(
-        org_attributes.fillna('').sample(n=10), headers='keys', tablefmt='pretty', showindex=False, missingval=''))
-
-    print('\nFinal Data of Phones:\n')
-    print(tabulate(
-        phone_data.fillna('').sample(n=10), headers='keys', tablefmt='pretty', showindex=False, missingval=''))
-
-    print('\nFinal Data of Addresses:\n')
-    print(tabulate(
-        address.fillna('').sample(n=10), headers='keys', tablefmt='pretty', showindex=False, missingval=''))
-
-    print('\nFinal Data of Custom Fields:\n')
-    print(tabulate(
-        custom_fields.fillna('').sample(n=10), headers='keys', tablefmt='pretty', showindex=False, missingval=''))
-
-    ####################################################################################################################
-    #                                              Exporting Data to CSV                                               #
-    ####################################################################################################################
-    export_to_csv(org, 'Organisations.csv')
-    export_to_csv(org_attributes, 'Organisation Attributes.csv')
-    export_to_csv(phone_data, 'Phones.csv')
-    export_to_csv(address, 'Address.csv')
-    export_to_csv(custom_fields, 'Custom_Fields.csv')
-
-except Exception as e:
-    print(e)
+    custom_fields['CAttrCom'] = custom_fields['CAttrCom'].str[:50]
+
+    return {'custom_fields': custom_fields}
+
+
+# Table columns read by each stage. A stage is only recomputed when they, its other inputs or this script changed.
+STAGE_INPUTS = {
+    'Mapping': {'re_la_map': ['re_id', 'la_id']},
+    'Organisations': {
+        'la_employment': [
+            'personid', 'Employment Company Name', 'Employment Title', 'Employment Start Year',
+            'Employment Start Month', 'Employment End Year', 'Employment End Month', 'Company Industry Name',
+            'Employment Position Is Current', 'Employment Position Is Primary', 'Employment Title Is Senior',
+            'Employment Salary Min', 'Employment Salary Max', 'Company Record Standardized Name', 'Company Type Type',
+            'Company Details Size', 'Company Details Sector', 'Person Headline', 'position_rank'
+        ],
+        're_la_map': ['re_id', 'la_id'],
+        'Org_Relationships': ['ConsID', 'ORFullName', 'ORImpID'],
+        'Org_Relationship_Attributes': ['ORAttrImpID', 'ORAttrORImpID', 'ORAttrCat', 'ORAttrDate', 'ORAttrDesc',
+                                        'ORAttrCom']
+    },
+    'LinkedIn': {
+        'Live_Alumni': ['personid'] + CHANGE_FIELDS['LinkedIn'],
+        're_la_map': ['re_id', 'la_id'],
+        'Phone_List': ['ConsID', 'PhoneType', 'PhoneNum']
+    },
+    'Emails': {
+        'Live_Alumni': ['personid'] + CHANGE_FIELDS['Emails'],
+        're_la_map': ['re_id', 'la_id'],
+        'Phone_List': ['ConsID', 'PhoneType', 'PhoneNum']
+    },
+    'Addresses': {
+        'Live_Alumni': ['personid'] + CHANGE_FIELDS['Addresses'],
+        're_la_map': ['re_id', 'la_id'],
+        'Country_Mapping': ['Country in Live Alumni', 'Country in Raisers Edge'],
+        'Addresses': ['ConsID', 'AddrCity', 'AddrCounty', 'AddrState', 'AddrCountry', 'PrefAddr']
+    },
+    'Custom Fields': {}
+}
+
+# Version of the code, part of every stage fingerprint
+with open(__file__, 'rb') as f:
+    CODE_VERSION = hashlib.sha1(f.read()).hexdigest()
+
+# Fingerprints of the table columns read by this run
+table_fingerprints = {}
+
+# Stages to run, e.g. 'Organisations,Addresses'. The others are skipped, along with the people they would update.
+selected_stages = [stage.strip() for stage in os.getenv('STAGES', ','.join(CHANGE_FIELDS)).split(',') if stage.strip()]
+
+# Number of alumni to process, for a quick validation run. 0 processes everyone.
+SAMPLE_SIZE = int(os.getenv('SAMPLE_SIZE', '0'))
+
+# Tables of the people each stage and the sample are restricted to. Named after the run, as other runs on the same
+# workspace may be writing theirs at the same time.
+RUN_ID = uuid.uuid4().hex[:12]
+CHANGED_PEOPLE = f'Changed_People_{RUN_ID}'
+SAMPLED_PEOPLE = f'Sampled_People_{RUN_ID}'
+
+# Import IDs reserved for each workspace, more than a run ever needs
+IMPORT_ID_BLOCK = int(os.getenv('IMPORT_ID_BLOCK', '100000000'))
+
+# Where the files to import in RE are exported
+OUTPUT_DIR = os.getenv('OUTPUT_DIR', 'Final')
+
+# Database of the workspace, connected to by main
+client = None
+
+# Per-stage run metrics
+run_metrics = []
+active_stage = {}
+
+# Peak memory of each stage, enabled with PROFILE_MEMORY as tracing every allocation slows the whole run down
+trace_memory = env_flag('PROFILE_MEMORY')
+
+# SQL profile, enabled with PROFILE_SQL
+query_profile = {}
+slow_queries = {}
+
+# CPU profile, enabled with PROFILE_CPU: the sampled stacks, by stage, and the functions listed as hotspots
+stack_samples = Counter()
+profile_interval_ms = 0
+CPU_HOTSPOTS = 50
+
+
+# Remove the tables written by this run, whether or not it completed
+def drop_run_tables():
+    if client is None:
+        return
+
+    for table in [CHANGED_PEOPLE, SAMPLED_PEOPLE]:
+        try:
+            drop_table(client, table)
+
+        except Exception as e:
+            print(f'Unable to drop table {table}: {e}')
+
+
+def main():
+    global client
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    profiler = None
+
+    if env_flag('PROFILE_CPU'):
+        profiler = start_cpu_profiler(float(os.getenv('PROFILE_INTERVAL_MS', '10')))
+
+    try:
+        print(f'Connecting to {get_backend()} database...')
+        client = connect_to_db()
+
+        if env_flag('PROFILE_SQL'):
+            if get_backend() == 'postgres':
+                attach_query_profiler(client, float(os.getenv('SLOW_QUERY_MS', '500')))
+
+            else:
+                print('SQL profiling is only available with the postgres backend\n')
+
+        ensure_derived_tables(client, get_store_dir(get_workspace()))
+
+        # Every query reads only the sampled people, so restricting them restricts the whole run
+        if SAMPLE_SIZE:
+            sampled_people = sample_people()
+            write_table(client, SAMPLED_PEOPLE, sampled_people)
+
+            print(f'\nSample run on {sampled_people.shape[0]} alumni')
+
+        ################################################################################################################
+        #                                                  1. MAPPING                                                  #
+        ################################################################################################################
+
+        print('\nMapping RE ID with respective Live Alumni ID... \n')
+        mapping = run_stage('Mapping', map_records, {})['mapping']
+
+        print('Detecting changes since the last successful run...\n')
+        with track_stage('Change Detection') as stage:
+            person_hashes = get_person_hashes()
+            changed_people = get_changed_people(person_hashes)
+
+            stage['rows_out'] = sum(df.shape[0] for df in changed_people.values())
+
+        # Stages left out of STAGES process nobody, and their snapshots are kept for the next run
+        for name in CHANGE_FIELDS:
+            if name not in selected_stages:
+                changed_people[name] = changed_people[name].head(0)
+                person_hashes = person_hashes.drop(columns=name)
+
+        for name, df in changed_people.items():
+            print(f'{name}: {df.shape[0]} of {person_hashes.shape[0]} people changed')
+
+        ################################################################################################################
+        #                                               2. Organisations                                               #
+        ################################################################################################################
+
+        print('Working on Organisations...\n')
+        organisations = run_stage('Organisations', process_organisations, {
+            'mapping': mapping,
+            'changed_people': changed_people['Organisations']
+        }, {
+            'max_org_import_id': get_import_ids('max_org_import_id'),
+            'max_org_attribute_imp_id': get_import_ids('max_org_attribute_imp_id')
+        })
+
+        org = organisations['org']
+        org_attributes = organisations['org_attributes']
+
+        ################################################################################################################
+        #                                                3. LinkedIn                                                   #
+        ################################################################################################################
+
+        print('Working on LinkedIn URLs...\n')
+        linkedin_data = run_stage('LinkedIn', process_linkedin, {
+            'changed_people': changed_people['LinkedIn']
+        })['linkedin_data']
+
+        ################################################################################################################
+        #                                                4. Emails                                                     #
+        ################################################################################################################
+
+        print('Working on Email addresses...\n')
+        emails = run_stage('Emails', process_emails, {
+            'linkedin_data': linkedin_data,
+            'changed_people': changed_people['Emails']
+        }, {
+            'max_phone_import_id': get_import_ids('max_phone_import_id')
+        })
+
+        phone_data = emails['phone_data']
+
+        ################################################################################################################
+        #                                                5. Addresses                                                  #
+        ################################################################################################################
+
+        print('Working on Addresses...\n')
+        addresses = run_stage('Addresses', process_addresses, {'changed_people': changed_people['Addresses']}, {
+            'max_address_imp_id': get_import_ids('max_address_imp_id')
+        })
+
+        address = addresses['address']
+
+        ################################################################################################################
+        #                                             6. Custom Fields                                                 #
+        ################################################################################################################
+
+        custom_fields = run_stage('Custom Fields', process_custom_fields, {
+            'verified_email': emails['verified_email'],
+            'new_emails': emails['new_emails'],
+            'verified_address': addresses['verified_address'],
+            'new_address': addresses['new_address'],
+            'new_organisations': organisations['new_organisations']
+        }, {
+            'max_attribute_import_id': get_import_ids('max_attribute_import_id')
+        })['custom_fields']
+
+        ################################################################################################################
+        #                                               Final Data                                                     #
+        ################################################################################################################
+
+        print('\nFinal Data of Organisations:\n')
+        print_preview(org)
+
+        print('\nFinal Data of Organisation Attributes:\n')
+        print_preview(org_attributes)
+
+        print('\nFinal Data of Phones:\n')
+        print_preview(phone_data)
+
+        print('\nFinal Data of Addresses:\n')
+        print_preview(address)
+
+        print('\nFinal Data of Custom Fields:\n')
+        print_preview(custom_fields)
+
+        ################################################################################################################
+        #                                            Exporting Data to CSV                                             #
+        ################################################################################################################
+        with track_stage('Export') as stage:
+            export_to_csv(org, 'Organisations.csv')
+            export_to_csv(org_attributes, 'Organisation Attributes.csv')
+            export_to_csv(phone_data, 'Phones.csv')
+            export_to_csv(address, 'Address.csv')
+            export_to_csv(custom_fields, 'Custom_Fields.csv')
+
+            stage['rows_out'] = org.shape[0] + org_attributes.shape[0] + phone_data.shape[0] + address.shape[0] + \
+                custom_fields.shape[0]
+
+        # The next run only processes the people who changed after this one. A sample run leaves out everyone else.
+        if not SAMPLE_SIZE:
+            save_person_snapshots(person_hashes)
+
+    except Exception as e:
+        print(e)
+        status = 1
+
+    else:
+        status = 0
+
+    finally:
+        drop_run_tables()
+
+    # Saving the run report, including the stages completed before any failure
+    export_metrics('Run Metrics.json')
+
+    if query_profile:
+        export_query_profile('SQL Profile.json')
+
+    if profiler is not None:
+        stop_cpu_profiler(profiler)
+        export_cpu_profile('CPU Profile.json')
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+import pandas as pd
+import json
+import os
+import shutil
+import uuid
+
+# Results of processing stages, by the fingerprint of what they read. Shared by every workspace, as the same inputs
+# give the same result whoever loaded them.
+CHECKPOINT_DIR = os.getenv('CHECKPOINT_DIR', 'Checkpoints')
+
+# Disk space the results may take. The least recently used ones are evicted past it.
+STAGE_CACHE_MB = float(os.getenv('STAGE_CACHE_MB', '2048'))
+
+
+def get_result_dir(fingerprint):
+    return os.path.join(CHECKPOINT_DIR, fingerprint)
+
+
+def load_result(fingerprint):
+    result_file = os.path.join(get_result_dir(fingerprint), 'result.json')
+
+    if not os.path.exists(result_file):
+        return None
+
+    try:
+        with open(result_file) as f:
+            result = json.load(f)
+
+        outputs = {
+            frame: pd.read_parquet(os.path.join(get_result_dir(fingerprint), f'{frame}.parquet'))
+            for frame in result['frames']
+        }
+
+    # Evicted or purged while being read
+    except (OSError, ValueError):
+        return None
+
+    # Eviction goes by the time a result was last used
+    os.utime(result_file)
+
+    return outputs
+
+
+def save_result(name, fingerprint, outputs, high_water_marks):
+    # Written aside, then moved into place at once, so that a run never reads the result of another one half-written
+    temp_dir = os.path.join(CHECKPOINT_DIR, f'.{fingerprint}.{uuid.uuid4().hex[:8]}')
+    os.makedirs(temp_dir)
+
+    try:
+        for frame, df in outputs.items():
+            # Columns mixing types (e.g. booleans and text attributes) are stored as text, as they are exported anyway
+            df = df.copy()
+            for col in df.select_dtypes(include='object').columns:
+                df[col] = df[col].astype(str).where(df[col].notna())
+
+            df.to_parquet(os.path.join(temp_dir, f'{frame}.parquet'), index=False)
+
+        # Written last, so that a result only counts once all its frames are saved
+        with open(os.path.join(temp_dir, 'result.json'), 'w') as f:
+            json.dump({
+                'stage': name,
+                'frames': list(outputs),
+                'high_water_marks': high_water_marks,
+                'completed_at': pd.Timestamp.now().isoformat(timespec='seconds')
+            }, f, indent=2)
+
+        os.rename(temp_dir, get_result_dir(fingerprint))
+
+    # Another run may have saved the same result in the meantime, which is just as good
+    except OSError:
+        if not os.path.exists(os.path.join(get_result_dir(fingerprint), 'result.json')):
+            raise
+
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    evict_results()
+
+
+# Saved results, with their size and the time they were last used
+def list_results():
+    if not os.path.isdir(CHECKPOINT_DIR):
+        return []
+
+    results = []
+
+    for entry in os.scandir(CHECKPOINT_DIR):
+        result_file = os.path.join(entry.path, 'result.json')
+
+        # Results still being written start with a dot
+        if entry.name.startswith('.') or not os.path.exists(result_file):
+            continue
+
+        results.append({
+            'fingerprint': entry.name,
+            'last_used': os.path.getmtime(result_file),
+            'size': sum(f.stat().st_size for f in os.scandir(entry.path))
+        })
+
+    return results
+
+
+def get_cache_size():
+    return sum(result['size'] for result in list_results())
+
+
+# Keep the most recently used results that fit in max_mb
+def evict_results(max_mb=STAGE_CACHE_MB):
+    total = 0
+
+    for result in sorted(list_results(), key=lambda result: result['last_used'], reverse=True):
+        total += result['size']
+
+        if total > max_mb * 1024 ** 2:
+            shutil.rmtree(get_result_dir(result['fingerprint']), ignore_errors=True)
+
+
+# Remove every saved result, along with anything else left in CHECKPOINT_DIR by older versions, except the results
+# being written by running jobs
+def purge_results():
+    if not os.path.isdir(CHECKPOINT_DIR):
+        return
+
+    for entry in os.scandir(CHECKPOINT_DIR):
+        if entry.name.startswith('.'):
+            continue
+
+        if entry.is_dir():
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+        else:
+            os.remove(entry.path)
@@ -0,0 +1,16 @@
+import os
+import sqlite3
+
+# Local database for what has to outlive a single run and a reload of the Postgres database
+STATE_DB = os.getenv('STATE_DB', 'State/state.sqlite')
+
+
+def connect_to_state():
+    os.makedirs(os.path.dirname(STATE_DB) or '.', exist_ok=True)
+
+    conn = sqlite3.connect(STATE_DB, timeout=30)
+
+    # Let readers carry on while a run writes
+    conn.execute('PRAGMA journal_mode=WAL;')
+
+    return conn
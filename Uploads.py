@@ -0,0 +1,695 @@
+import pandas as pd
+import pyarrow as pa
+import codecs
+import csv
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import uuid
+
+from pyarrow import compute as pc
+from pyarrow import csv as pa_csv
+
+# Bump whenever the way uploads are parsed changes, so that older columnar copies are not reused
+SCHEMA_VERSION = 3
+
+# Size of the blocks read while hashing and converting uploads
+CHUNK_SIZE = 8 * 1024 ** 2
+
+# Directory holding the columnar copy of the uploads
+STORE_DIR = os.getenv('COLUMNAR_STORE', 'Store')
+
+# Directory where uploads are spooled before loading
+SPOOL_DIR = os.getenv('SPOOL_DIR') or tempfile.gettempdir()
+
+# Wide uploads, of which only the columns declared in FILE_SCHEMAS are loaded into their table
+PROJECTED_FILES = ['Live Alumni.csv']
+
+# What becomes of the other columns of PROJECTED_FILES: 'skip' (default) leaves them out, 'sidecar' packs them into a
+# JSON document per row, in a compressed <table>_Extra table keyed like the upload
+EXTRA_COLUMNS = os.getenv('EXTRA_COLUMNS', 'skip').strip().lower()
+
+# Bytes read from the start of each upload to check it before loading, enough for the header and a few hundred rows
+PREFLIGHT_BYTES = 64 * 1024
+
+# Types of the columns the pipeline relies on, for each upload. Every one of them must be in the upload, while the
+# columns not listed are loaded as text.
+FILE_SCHEMAS = {
+    'Live Alumni.csv': {
+        'personid': 'bigint',
+        'Person Constituent ID': 'bigint',
+        'Person Level 1 Constituent ID': 'bigint',
+        'Person Level 2 Constituent ID': 'bigint',
+        'Person URL': 'text',
+        'Person Email': 'text',
+        'Contact Data Business Email': 'text',
+        'Personal Industry Name': 'text',
+        'Employment Company Name': 'text',
+        'Employment Title': 'text',
+        'Employment Start Year': 'bigint',
+        'Employment Start Month': 'bigint',
+        'Employment End Year': 'bigint',
+        'Employment End Month': 'bigint',
+        'Company Industry Name': 'text',
+        'Employment Salary Min': 'double',
+        'Employment Salary Max': 'double',
+        'Employment Position Is Current': 'boolean',
+        'Employment Position Is Primary': 'boolean',
+        'Employment Title Is Senior': 'boolean',
+        'Employment Seniority Level': 'text',
+        'Company Record Standardized Name': 'text',
+        'Company Record Historic Head Count': 'text',
+        'Company Record Current Head Count': 'text',
+        'Company Type Type': 'text',
+        'Company Details Size': 'text',
+        'Company Details Sector': 'text',
+        'Company Details Website': 'text',
+        'Person Headline': 'text',
+        'Location City': 'text',
+        'Location State/Province': 'text',
+        'Location Country': 'text'
+    },
+    'Custom Fields.csv': {
+        'CAttrImpID': 'text',
+        'CAttrCat': 'text',
+        'CAttrCom': 'text',
+        'ConsID': 'bigint',
+        'CAttrDate': 'date',
+        'CAttrDesc': 'text'
+    },
+    'Phone List.csv': {
+        'PhoneImpID': 'text',
+        'ConsID': 'bigint',
+        'PhoneType': 'text',
+        'PhoneNum': 'text',
+        'PhoneIsInactive': 'boolean',
+        'PhoneIsPrimary': 'boolean',
+        'PhoneComments': 'text'
+    },
+    'Org Relationships.csv': {
+        'ORImpID': 'text',
+        'ConsID': 'bigint',
+        'ORFullName': 'text'
+    },
+    'Org Relationship Attributes.csv': {
+        'ORAttrImpID': 'text',
+        'ORAttrORImpID': 'text',
+        'ORAttrCat': 'text',
+        'ORAttrDate': 'date',
+        'ORAttrDesc': 'text',
+        'ORAttrCom': 'text'
+    },
+    'Addresses.csv': {
+        'AddrImpID': 'text',
+        'ConsID': 'bigint',
+        'AddrCity': 'text',
+        'AddrCounty': 'text',
+        'AddrState': 'text',
+        'AddrCountry': 'text',
+        'PrefAddr': 'boolean'
+    },
+    'Matches.csv': {
+        'personid': 'bigint',
+        'ConsID': 'bigint'
+    }
+}
+
+# Columns identifying the records of each upload. A row is rejected when one of them can't be read, while other values
+# that don't fit their type are left empty.
+KEY_COLUMNS = {
+    'Live Alumni.csv': ['personid'],
+    'Custom Fields.csv': ['ConsID'],
+    'Phone List.csv': ['ConsID'],
+    'Org Relationships.csv': ['ConsID'],
+    'Org Relationship Attributes.csv': [],
+    'Addresses.csv': ['ConsID'],
+    'Matches.csv': ['personid', 'ConsID']
+}
+
+ARROW_TYPES = {
+    'bigint': pa.int64(),
+    'double': pa.float64(),
+    'boolean': pa.bool_(),
+    'date': pa.date32(),
+    'text': pa.string()
+}
+
+TRUE_VALUES = ['True', 'true', 'TRUE', 'Yes', 'yes', 'Y', '1']
+FALSE_VALUES = ['False', 'false', 'FALSE', 'No', 'no', 'N', '0']
+
+# Formats of the dates found in the exports, tried in order
+DATE_FORMATS = ['%Y-%m-%d', '%d-%b-%Y', '%m/%d/%Y', '%Y-%m-%d %H:%M:%S']
+
+# Rejected values listed in the report of each load. All of them are counted.
+REJECTS_LIMIT = 1000
+
+
+# Table name of an upload, e.g. 'Phone List.csv' -> 'Phone_List'
+def table_name(file_name):
+    return re.sub('[^a-zA-Z _]', '', file_name).replace('csv', '').strip().title().replace(' ', '_')
+
+
+########################################################################################################################
+#                                                  Content Hashing                                                     #
+########################################################################################################################
+
+# Digests of uploads already hashed, by Streamlit's file id
+_digests = {}
+
+
+def file_digest(file):
+    # Streamlit gives every upload a unique id, so the same upload need not be hashed on every rerun
+    file_id = getattr(file, 'file_id', None)
+
+    if file_id is not None and file_id in _digests:
+        return _digests[file_id]
+
+    digest = hashlib.blake2b(digest_size=20)
+
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+
+    else:
+        file.seek(0)
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+        file.seek(0)
+
+    if file_id is not None:
+        _digests[file_id] = digest.hexdigest()
+
+    return digest.hexdigest()
+
+
+########################################################################################################################
+#                                                     Preflight                                                        #
+########################################################################################################################
+
+# First PREFLIGHT_BYTES of an upload, and its size
+def read_head(file):
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as f:
+            return f.read(PREFLIGHT_BYTES), os.path.getsize(file)
+
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+
+    file.seek(0)
+    head = file.read(PREFLIGHT_BYTES)
+    file.seek(0)
+
+    return head, size
+
+
+# Check the encoding, the columns and the first rows of an upload, without reading the rest of it, so that a wrong file
+# is rejected before anything is loaded. Returns what was found, with the number of rows estimated from the file size.
+def preflight_upload(file, file_name=None):
+    file_name = file_name or os.path.basename(getattr(file, 'name', file))
+
+    head, size = read_head(file)
+
+    if not head.strip():
+        raise ValueError(f'{file_name} is empty')
+
+    # Uploads are read as single-byte text, which neither survives
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)) or b'\x00' in head:
+        raise ValueError(f'{file_name} is saved as UTF-16. Please export it again as CSV.')
+
+    if head.startswith(codecs.BOM_UTF8):
+        raise ValueError(f"{file_name} is saved as 'CSV UTF-8', which renames its first column. Please save it as "
+                         f"'CSV (Comma delimited)'.")
+
+    # Split only on line breaks, as validate_upload does. str.splitlines also splits on characters such as \x85, the
+    # cp1252 ellipsis and the second byte of UTF-8 letters such as Å.
+    lines = io.StringIO(head.decode('latin1'), newline='').readlines()
+    truncated = len(head) < size
+
+    # The last line read is likely cut short
+    if truncated and len(lines) > 1:
+        lines = lines[:-1]
+
+    reader = csv.reader(lines)
+    header = next(reader)
+
+    missing = [col for col in FILE_SCHEMAS.get(file_name, {}) if col not in header]
+
+    if missing:
+        raise ValueError(f"{file_name} is missing the columns: {', '.join(missing)}")
+
+    rows = 0
+    bad_rows = []
+
+    for record in reader:
+        if not record:
+            continue
+
+        rows += 1
+
+        if len(record) != len(header):
+            bad_rows.append(reader.line_num)
+
+    # A quoted value spanning the cut may look short, so the last row only counts when the whole file was read
+    if truncated and bad_rows and bad_rows[-1] == reader.line_num:
+        bad_rows.pop()
+
+    if bad_rows:
+        raise ValueError(
+            f"{file_name} has rows without {len(header)} fields, at lines "
+            f"{', '.join(str(line) for line in bad_rows[:10])}"
+        )
+
+    header_bytes = len(lines[0])
+    body_bytes = sum(len(line) for line in lines[1:])
+
+    if truncated and body_bytes:
+        rows = round((size - header_bytes) * rows / body_bytes)
+
+    return {'file': file_name, 'columns': len(header), 'size_mb': round(size / 1024 ** 2, 1), 'estimated_rows': rows}
+
+
+########################################################################################################################
+#                                                     Spooling                                                         #
+########################################################################################################################
+
+# Copy an upload to a temporary file in CHUNK_SIZE blocks, hashing it on the way. Returns the path and the digest.
+def spool_upload(file):
+    digest = hashlib.blake2b(digest_size=20)
+
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+
+    file.seek(0)
+
+    with tempfile.NamedTemporaryFile(dir=SPOOL_DIR, suffix='.csv', delete=False) as spool:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            spool.write(chunk)
+            digest.update(chunk)
+
+    file.seek(0)
+
+    file_id = getattr(file, 'file_id', None)
+
+    if file_id is not None:
+        _digests[file_id] = digest.hexdigest()
+
+    return spool.name, digest.hexdigest()
+
+
+# Read a spooled upload record by record and check that it is a well-formed CSV. Returns the number of records.
+def validate_upload(path, file_name):
+    with open(path, encoding='latin1', newline='') as f:
+        reader = csv.reader(f)
+
+        header = next(reader, None)
+
+        if not header:
+            raise ValueError(f'{file_name} is empty')
+
+        duplicates = {col for col in header if header.count(col) > 1}
+
+        if '' in header or duplicates:
+            raise ValueError(f"{file_name} has blank or duplicate column names: {', '.join(duplicates)}")
+
+        rows = 0
+        bad_rows = []
+
+        for record in reader:
+            # Blank lines are skipped by every loader
+            if not record:
+                continue
+
+            rows += 1
+
+            if len(record) != len(header):
+                bad_rows.append(reader.line_num)
+
+    if bad_rows:
+        raise ValueError(
+            f"{file_name} has {len(bad_rows)} rows without {len(header)} fields, at lines "
+            f"{', '.join(str(line) for line in bad_rows[:10])}"
+        )
+
+    return rows
+
+
+# Read a small upload in full, such as the manual matches. The large ones are read through the columnar store, which
+# converts each content once.
+def read_upload(file, **read_options):
+    read_options.setdefault('low_memory', False)
+
+    if not isinstance(file, (str, os.PathLike)):
+        file.seek(0)
+
+    return pd.read_csv(file, **read_options)
+
+
+########################################################################################################################
+#                                                  Type Coercion                                                       #
+########################################################################################################################
+
+def read_header(file):
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, encoding='latin1', newline='') as f:
+            return next(csv.reader(f), [])
+
+    file.seek(0)
+    header = next(csv.reader([file.readline().decode('latin1')]), [])
+    file.seek(0)
+
+    return header
+
+
+# Only the given columns are read, as text, and then coerced to the type declared for them
+def open_csv_stream(file, columns):
+    if not isinstance(file, (str, os.PathLike)):
+        file.seek(0)
+
+    return pa_csv.open_csv(
+        file,
+        read_options=pa_csv.ReadOptions(encoding='latin1', block_size=CHUNK_SIZE),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={col: pa.string() for col in columns},
+            include_columns=columns,
+            strings_can_be_null=True
+        )
+    )
+
+
+# Columns of an upload loaded into its table
+def load_columns(file, file_name):
+    if file_name in PROJECTED_FILES:
+        return [col for col in read_header(file) if col in FILE_SCHEMAS[file_name]]
+
+    return read_header(file)
+
+
+# What becomes of the extra columns of an upload, only ever packed for PROJECTED_FILES
+def extra_columns_mode(file_name):
+    return EXTRA_COLUMNS if file_name in PROJECTED_FILES else 'skip'
+
+
+# Columns of an upload packed into its sidecar table, if it has one
+def extra_columns(file, file_name):
+    if extra_columns_mode(file_name) != 'sidecar':
+        return []
+
+    return [col for col in read_header(file) if col not in FILE_SCHEMAS[file_name]]
+
+
+def sidecar_table(file_name):
+    return f'{table_name(file_name)}_Extra'
+
+
+# Key of the upload, and a JSON document of the extra columns of the row
+def sidecar_schema(file_name):
+    key = KEY_COLUMNS[file_name][0]
+
+    return pa.schema([pa.field(key, ARROW_TYPES[FILE_SCHEMAS[file_name][key]]), pa.field('data', pa.string())])
+
+
+# Pack the extra columns of a batch into a JSON document per row, leaving out empty values and rows without a key
+def pack_extra(batch, file_name, columns):
+    key = KEY_COLUMNS[file_name][0]
+    keys, _ = coerce_column(batch.column(key), FILE_SCHEMAS[file_name][key])
+
+    documents = pa.array([
+        json.dumps({col: value for col, value in row.items() if value is not None})
+        for row in batch.select(columns).to_pylist()
+    ], pa.string())
+
+    packed = pa.RecordBatch.from_arrays([keys, documents], schema=sidecar_schema(file_name))
+
+    return packed.filter(pc.is_valid(keys))
+
+
+# Shadow column holding the digits of a dashed import ID, e.g. '10810-000-0000000197' -> 108100000000000197
+def shadow_column(col):
+    return f'{col}_num'
+
+
+def import_id_columns(file_name):
+    return [col for col in FILE_SCHEMAS.get(file_name, {}) if col.endswith('ImpID')]
+
+
+# Values of the given type, and the values that couldn't be read as such
+def coerce_column(values, col_type):
+    trimmed = pc.utf8_trim_whitespace(values)
+
+    match col_type:
+        case 'bigint':
+            valid = pc.match_substring_regex(trimmed, r'^[+-]?\d{1,18}(\.0+)?$')
+            digits = pc.replace_substring_regex(pc.if_else(valid, trimmed, None), r'(^\+)|(\.0+$)', '')
+            typed = pc.cast(digits, pa.int64())
+
+        case 'double':
+            valid = pc.match_substring_regex(trimmed, r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$')
+            typed = pc.cast(pc.if_else(valid, pc.replace_substring_regex(trimmed, r'^\+', ''), None), pa.float64())
+
+        case 'boolean':
+            is_true = pc.is_in(trimmed, value_set=pa.array(TRUE_VALUES))
+            is_false = pc.is_in(trimmed, value_set=pa.array(FALSE_VALUES))
+            typed = pc.if_else(pc.or_(is_true, is_false), is_true, None)
+
+        case 'date':
+            typed = pc.coalesce(*[
+                pc.strptime(trimmed, format=date_format, unit='s', error_is_null=True) for date_format in DATE_FORMATS
+            ]).cast(pa.date32())
+
+        case _:
+            return values, pa.array([False] * len(values))
+
+    # Blanks are missing values, not rejected ones
+    invalid = pc.and_(pc.not_equal(trimmed, ''), pc.is_null(typed))
+
+    return typed, pc.fill_null(invalid, False)
+
+
+# Coerce a batch read as text to the declared types, add the import ID shadow columns and drop the rejected rows
+def coerce_batch(batch, file_name, first_row, rejects):
+    schema = FILE_SCHEMAS.get(file_name, {})
+    columns = {}
+    rejected = pa.array([False] * batch.num_rows)
+
+    for col in batch.column_names:
+        typed, invalid = coerce_column(batch.column(col), schema.get(col, 'text'))
+        columns[col] = typed
+
+        if pc.any(invalid).as_py():
+            is_key = col in KEY_COLUMNS.get(file_name, [])
+            rows = pc.indices_nonzero(invalid)
+
+            rejects.add(file_name, pd.DataFrame({
+                'row': pc.add(rows, first_row).to_numpy(),
+                'column': col,
+                'value': pc.take(batch.column(col), rows).to_pylist(),
+                'action': 'row rejected' if is_key else 'value left empty'
+            }))
+
+            if is_key:
+                rejected = pc.or_(rejected, invalid)
+
+    for col in import_id_columns(file_name):
+        if col in columns:
+            digits = pc.replace_substring(columns[col], '-', '')
+            valid = pc.match_substring_regex(digits, r'^\d{1,18}$')
+            columns[shadow_column(col)] = pc.cast(pc.if_else(valid, digits, None), pa.int64())
+
+    typed = pa.RecordBatch.from_pydict(columns)
+
+    if pc.any(rejected).as_py():
+        typed = typed.filter(pc.invert(rejected))
+
+    return typed
+
+
+class RejectLog:
+    def __init__(self, limit=REJECTS_LIMIT):
+        self.limit = limit
+        self.entries = []
+        self.listed = 0
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, file_name, rejects):
+        with self.lock:
+            for action, count in rejects['action'].value_counts().items():
+                self.counts[(file_name, action)] = self.counts.get((file_name, action), 0) + count
+
+            if self.listed < self.limit:
+                rejects = rejects.head(self.limit - self.listed).assign(file=file_name)
+                self.entries.append(rejects)
+                self.listed += rejects.shape[0]
+
+    def rejected_rows(self, file_name):
+        return self.counts.get((file_name, 'row rejected'), 0)
+
+    def summary(self):
+        return pd.DataFrame(
+            [(file_name, action, count) for (file_name, action), count in self.counts.items()],
+            columns=['file', 'action', 'count']
+        )
+
+    def report(self):
+        if not self.entries:
+            return pd.DataFrame(columns=['file', 'row', 'column', 'value', 'action'])
+
+        return pd.concat(self.entries, ignore_index=True)[['file', 'row', 'column', 'value', 'action']]
+
+
+# Stream an upload as typed record batches of at most CHUNK_SIZE bytes of text, each with the batch of its sidecar, or
+# None when it has none. Rows are numbered from 1, after the header.
+def read_projected_batches(file, file_name, rejects):
+    columns = load_columns(file, file_name)
+    extra = extra_columns(file, file_name)
+    first_row = 1
+
+    with open_csv_stream(file, columns + extra) as reader:
+        for batch in reader:
+            typed = coerce_batch(batch.select(columns), file_name, first_row, rejects)
+
+            yield typed, pack_extra(batch, file_name, extra) if extra else None
+
+            first_row += batch.num_rows
+
+
+########################################################################################################################
+#                                                  Columnar Store                                                      #
+########################################################################################################################
+
+manifest_lock = threading.Lock()
+
+
+def read_manifest(store_dir=STORE_DIR):
+    manifest_file = os.path.join(store_dir, 'manifest.json')
+
+    if not os.path.exists(manifest_file):
+        return {}
+
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+# Replaced at once, so that readers never see a partly written manifest
+def write_manifest(manifest, store_dir=STORE_DIR):
+    manifest_file = os.path.join(store_dir, 'manifest.json')
+
+    with open(f'{manifest_file}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    os.replace(f'{manifest_file}.tmp', manifest_file)
+
+
+def typed_schema(file, file_name):
+    columns = load_columns(file, file_name)
+
+    fields = [pa.field(col, ARROW_TYPES[FILE_SCHEMAS.get(file_name, {}).get(col, 'text')]) for col in columns]
+    fields += [pa.field(shadow_column(col), pa.int64()) for col in import_id_columns(file_name) if col in columns]
+
+    return pa.schema(fields)
+
+
+# Write the table of an upload, and its sidecar to extra_path when it has one. The sidecar is compressed, as it is
+# rarely read.
+def write_arrow(file, file_name, path, rejects, extra_path=None):
+    rows = 0
+    extra_writer = None
+
+    if extra_path and extra_columns(file, file_name):
+        extra_writer = pa.ipc.new_file(extra_path, sidecar_schema(file_name),
+                                       options=pa.ipc.IpcWriteOptions(compression='zstd'))
+
+    try:
+        with pa.ipc.new_file(path, typed_schema(file, file_name)) as writer:
+            for typed, extra in read_projected_batches(file, file_name, rejects):
+                writer.write_batch(typed)
+                rows += typed.num_rows
+
+                if extra_writer is not None:
+                    extra_writer.write_batch(extra)
+
+    finally:
+        if extra_writer is not None:
+            extra_writer.close()
+
+    return rows, extra_writer is not None
+
+
+# Convert an upload to an uncompressed Arrow IPC file, once per content, so that it can be memory-mapped later
+def to_columnar(file, file_name=None, store_dir=STORE_DIR, digest=None, rejects=None):
+    file_name = file_name or os.path.basename(getattr(file, 'name', file))
+    table = table_name(file_name)
+    digest = digest or file_digest(file)
+    rejects = rejects or RejectLog()
+
+    os.makedirs(store_dir, exist_ok=True)
+
+    manifest = read_manifest(store_dir)
+    path = os.path.join(store_dir, f'{table}.arrow')
+    extra_table = sidecar_table(file_name)
+    extra_path = os.path.join(store_dir, f'{extra_table}.arrow')
+
+    if manifest.get(table, {}).get('digest') == digest and \
+            manifest[table].get('schema_version') == SCHEMA_VERSION and \
+            manifest[table].get('extra_columns', 'skip') == extra_columns_mode(file_name) and os.path.exists(path):
+        return table
+
+    # Named for this conversion alone, as another one of the same file may be writing to the same store
+    suffix = f'.{uuid.uuid4().hex[:8]}.tmp'
+
+    try:
+        rows, has_sidecar = write_arrow(file, file_name, path + suffix, rejects, extra_path=extra_path + suffix)
+
+    except Exception:
+        for temp_path in [path + suffix, extra_path + suffix]:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        raise
+
+    os.replace(path + suffix, path)
+
+    if has_sidecar:
+        os.replace(extra_path + suffix, extra_path)
+
+    # A sidecar of an earlier load would not match this one
+    elif os.path.exists(extra_path):
+        os.remove(extra_path)
+
+    # Files of the same store may be converted at the same time, each adding its own entry
+    with manifest_lock:
+        manifest = read_manifest(store_dir)
+        manifest[table] = {
+            'file': file_name,
+            'digest': digest,
+            'schema_version': SCHEMA_VERSION,
+            'extra_columns': extra_columns_mode(file_name),
+            'rows': rows,
+            'rejected_rows': rejects.rejected_rows(file_name)
+        }
+
+        if has_sidecar:
+            manifest[extra_table] = {'file': file_name, 'digest': digest, 'schema_version': SCHEMA_VERSION}
+
+        else:
+            manifest.pop(extra_table, None)
+
+        write_manifest(manifest, store_dir)
+
+    return table
+
+
+# Memory-map a table of the columnar store and read only the requested columns
+def read_columnar(table, columns=None, store_dir=STORE_DIR):
+    with pa.memory_map(os.path.join(store_dir, f'{table}.arrow')) as source:
+        data = pa.ipc.open_file(source).read_all()
+
+        # Only the selected columns are paged in from disk
+        if columns is not None:
+            data = data.select([col for col in columns if col in data.column_names])
+
+        return data.to_pandas()
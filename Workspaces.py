@@ -0,0 +1,248 @@
+import pandas as pd
+import os
+import shutil
+import uuid
+
+from sqlalchemy import text
+from Database import get_backend, connect_to_db, get_schema, get_store_dir
+from State import connect_to_state
+
+# Workspaces, and the results of jobs, unused for this long are removed
+WORKSPACE_TTL_HOURS = float(os.getenv('WORKSPACE_TTL_HOURS', '24'))
+
+# Workspaces holding a complete load are kept longer, so that the data of a weekly refresh can be processed again
+LOADED_DATA_TTL_DAYS = float(os.getenv('LOADED_DATA_TTL_DAYS', '30'))
+
+
+########################################################################################################################
+#                                                  Workspace Table                                                     #
+########################################################################################################################
+
+def initialize_workspaces():
+    conn = connect_to_state()
+
+    with conn:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS workspaces (
+                workspace_id TEXT PRIMARY KEY,
+                created_at TEXT NOT NULL,
+                last_used_at TEXT NOT NULL,
+                loaded_at TEXT
+            );
+            """
+        )
+
+        # Workspace tables created before loads were recorded
+        if 'loaded_at' not in [row[1] for row in conn.execute('PRAGMA table_info(workspaces);')]:
+            conn.execute('ALTER TABLE workspaces ADD COLUMN loaded_at TEXT;')
+
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS loads (
+                workspace_id TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                rows INTEGER NOT NULL,
+                rejected_rows INTEGER NOT NULL,
+                loaded_at TEXT NOT NULL,
+                PRIMARY KEY (workspace_id, file_name)
+            );
+            """
+        )
+
+    conn.close()
+
+
+# Every upload gets its own workspace, so that loads and runs of different users don't overwrite each other. Scheduled
+# runs reuse a named one, to keep its import IDs from one run to the next.
+def create_workspace(workspace=None):
+    workspace = workspace or uuid.uuid4().hex[:12]
+    now = pd.Timestamp.now().isoformat(timespec='seconds')
+
+    if get_backend() == 'postgres':
+        with connect_to_db(workspace=None).begin() as conn:
+            conn.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{get_schema(workspace)}";'))
+
+    else:
+        os.makedirs(get_store_dir(workspace), exist_ok=True)
+
+    conn = connect_to_state()
+
+    with conn:
+        # Reusing a named workspace counts as using it, so that it isn't cleaned up in the middle of a run
+        conn.execute(
+            'INSERT INTO workspaces (workspace_id, created_at, last_used_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (workspace_id) DO UPDATE SET last_used_at = excluded.last_used_at;',
+            (workspace, now, now)
+        )
+
+    conn.close()
+
+    return workspace
+
+
+def touch_workspace(workspace):
+    conn = connect_to_state()
+
+    with conn:
+        conn.execute(
+            'UPDATE workspaces SET last_used_at = ? WHERE workspace_id = ?;',
+            (pd.Timestamp.now().isoformat(timespec='seconds'), workspace)
+        )
+
+    conn.close()
+
+
+def drop_workspace(workspace):
+    if get_backend() == 'postgres':
+        with connect_to_db(workspace=None).begin() as conn:
+            conn.execute(text(f'DROP SCHEMA IF EXISTS "{get_schema(workspace)}" CASCADE;'))
+
+    shutil.rmtree(get_store_dir(workspace), ignore_errors=True)
+
+    conn = connect_to_state()
+
+    with conn:
+        conn.execute('DELETE FROM loads WHERE workspace_id = ?;', (workspace,))
+        conn.execute('DELETE FROM workspaces WHERE workspace_id = ?;', (workspace,))
+
+        # Snapshots of the people processed in the workspace, kept by Processing.py once a run in it completed
+        if 'workspace' in [row[1] for row in conn.execute('PRAGMA table_info(person_snapshots);')]:
+            conn.execute('DELETE FROM person_snapshots WHERE workspace = ?;', (workspace,))
+
+    conn.close()
+
+
+########################################################################################################################
+#                                                    Load Table                                                        #
+########################################################################################################################
+
+# Forget the files of an earlier load of the workspace, which is no longer complete once its tables are replaced
+def start_load(workspace):
+    conn = connect_to_state()
+
+    with conn:
+        conn.execute('DELETE FROM loads WHERE workspace_id = ?;', (workspace,))
+        conn.execute('UPDATE workspaces SET loaded_at = NULL WHERE workspace_id = ?;', (workspace,))
+
+    conn.close()
+
+
+def record_file_loaded(workspace, file_name, digest, rows, rejected_rows):
+    conn = connect_to_state()
+
+    with conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO loads (workspace_id, file_name, digest, rows, rejected_rows, loaded_at) '
+            'VALUES (?, ?, ?, ?, ?, ?);',
+            (workspace, file_name, digest, rows, rejected_rows, pd.Timestamp.now().isoformat(timespec='seconds'))
+        )
+
+    conn.close()
+
+
+# Every file of the workspace is loaded and its derived tables are built, so that it can be processed
+def finish_load(workspace):
+    conn = connect_to_state()
+
+    with conn:
+        conn.execute(
+            'UPDATE workspaces SET loaded_at = ? WHERE workspace_id = ?;',
+            (pd.Timestamp.now().isoformat(timespec='seconds'), workspace)
+        )
+
+    conn.close()
+
+
+# Workspaces ready to be processed, most recently loaded first, with the number of files and rows they hold. They
+# outlive the session that loaded them, until they are unused for LOADED_DATA_TTL_DAYS.
+def get_loaded_workspaces():
+    conn = connect_to_state()
+
+    workspaces = pd.read_sql_query(
+        """
+        SELECT
+            w.workspace_id,
+            w.loaded_at,
+            COUNT(l.file_name) AS files,
+            COALESCE(SUM(l.rows), 0) AS rows,
+            COALESCE(SUM(l.rejected_rows), 0) AS rejected_rows
+        FROM
+            workspaces w
+            LEFT JOIN loads l ON l.workspace_id = w.workspace_id
+        WHERE
+            w.loaded_at IS NOT NULL
+        GROUP BY
+            w.workspace_id,
+            w.loaded_at
+        ORDER BY
+            w.loaded_at DESC;
+        """,
+        con=conn
+    )
+
+    conn.close()
+
+    return workspaces
+
+
+def get_loads(workspace):
+    conn = connect_to_state()
+
+    loads = pd.read_sql_query(
+        'SELECT file_name, digest, rows, rejected_rows, loaded_at FROM loads WHERE workspace_id = ? '
+        'ORDER BY file_name;',
+        con=conn,
+        params=(workspace,)
+    )
+
+    conn.close()
+
+    return loads
+
+
+########################################################################################################################
+#                                                      Cleanup                                                         #
+########################################################################################################################
+
+# Drop the workspaces unused for WORKSPACE_TTL_HOURS, or LOADED_DATA_TTL_DAYS once loaded, unless a job still needs
+# them
+def cleanup_workspaces():
+    expiry = (pd.Timestamp.now() - pd.Timedelta(hours=WORKSPACE_TTL_HOURS)).isoformat(timespec='seconds')
+    loaded_expiry = (pd.Timestamp.now() - pd.Timedelta(days=LOADED_DATA_TTL_DAYS)).isoformat(timespec='seconds')
+
+    conn = connect_to_state()
+
+    expired = conn.execute(
+        """
+        SELECT
+            workspace_id
+        FROM
+            workspaces
+        WHERE
+            last_used_at < CASE WHEN loaded_at IS NULL THEN ? ELSE ? END
+            AND workspace_id NOT IN (
+                SELECT
+                    json_extract(options, '$.WORKSPACE')
+                FROM
+                    jobs
+                WHERE
+                    status IN ('queued', 'running')
+                    AND json_extract(options, '$.WORKSPACE') IS NOT NULL
+            );
+        """,
+        (expiry, loaded_expiry)
+    ).fetchall()
+
+    conn.close()
+
+    for (workspace,) in expired:
+        try:
+            drop_workspace(workspace)
+
+        except Exception as e:
+            print(f'Unable to drop workspace {workspace}: {e}')
+
+
+initialize_workspaces()
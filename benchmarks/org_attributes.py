@@ -0,0 +1,100 @@
+# Micro-benchmark of the organisation attributes built for each employment row.
+# Run from the repository root with: python -m benchmarks.org_attributes [rows]
+import pandas as pd
+import numpy as np
+import duckdb
+import sys
+import time
+import tracemalloc
+
+import Processing
+
+SECTORS = ['Software', 'Software, Hardware, and Services', 'Banking, Insurance', 'Education', None]
+
+
+def sample_employment(rows):
+    rng = np.random.default_rng(0)
+
+    la_data = pd.DataFrame(data={
+        'Employment Title Is Senior': rng.choice([True, False, None], rows),
+        'Company Details Sector': rng.choice(np.array(SECTORS, dtype=object), rows),
+        'Company Details Size': rng.choice(['1-10', '11-50', '51-200', None], rows),
+        'Company Type Type': rng.choice(['Private', 'Public', None], rows)
+    })
+
+    import_ids = pd.Series([Processing.format_import_id(10820000000000000 + i) for i in range(rows)])
+
+    return la_data, import_ids
+
+
+# How the attributes used to be built: one small DataFrame per attribute value, concatenated row by row
+def row_by_row(la_data, import_ids):
+    org_attributes = pd.DataFrame()
+
+    for i, import_id in enumerate(import_ids):
+        data = la_data.iloc[[i]]
+        frames = []
+
+        sectors = data['Company Details Sector'].values[0]
+
+        if sectors is not None:
+            for sector in sectors.replace(', and ', ', ').replace(', ', ',').split(','):
+                frames.append(pd.DataFrame(data={
+                    'ORAttrORImpID': import_id, 'ORAttrImpID': np.nan, 'ORAttrCat': 'Sector', 'ORAttrDate': np.nan,
+                    'ORAttrDesc': sector.title(), 'ORAttrCom': 'Source: Live Alumni'
+                }, index=[0]))
+
+        for col, cat in [('Company Details Size', 'Employee Size'), ('Employment Title Is Senior', 'Senior Position'),
+                         ('Company Type Type', 'Company Type')]:
+            frames.append(pd.DataFrame(data={
+                'ORAttrORImpID': import_id, 'ORAttrImpID': np.nan, 'ORAttrCat': cat, 'ORAttrDate': np.nan,
+                'ORAttrDesc': data[col].values[0], 'ORAttrCom': 'Source: Live Alumni'
+            }, index=[0]))
+
+        attributes = pd.concat(frames, axis=0, ignore_index=True).dropna(subset=['ORAttrDesc'])
+        org_attributes = pd.concat([org_attributes, attributes], axis=0, ignore_index=True)
+
+    return org_attributes
+
+
+# Count every DataFrame constructed while func runs, along with its time and peak memory
+def measure(name, func, *args):
+    frames = 0
+    init = pd.DataFrame.__init__
+
+    def counting_init(self, *init_args, **init_kwargs):
+        nonlocal frames
+        frames += 1
+        init(self, *init_args, **init_kwargs)
+
+    pd.DataFrame.__init__ = counting_init
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    try:
+        result = func(*args)
+
+    finally:
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        pd.DataFrame.__init__ = init
+
+    rows = max(result.shape[0], 1)
+    print(f'{name:<12} {result.shape[0]:>8} rows out  {frames / rows:>8.3f} DataFrames/row  '
+          f'{elapsed * 1e6 / rows:>10.1f} us/row  {peak / rows:>10.1f} peak bytes/row')
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+    # No existing attributes in RE, so that only the construction of the new ones is measured
+    Processing.client = duckdb.connect()
+    Processing.client.register('Org_Relationship_Attributes', pd.DataFrame(columns=[
+        'ORAttrImpID', 'ORAttrORImpID', 'ORAttrCat', 'ORAttrDate', 'ORAttrDesc', 'ORAttrCom'
+    ], dtype=str))
+
+    la_data, import_ids = sample_employment(rows)
+
+    measure('row-by-row', row_by_row, la_data, import_ids)
+    measure('columnar', Processing.sync_org_attributes, la_data, import_ids)
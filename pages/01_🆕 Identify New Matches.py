@@ -1,6 +1,10 @@
 import streamlit as st
 import pandas as pd
-import numpy as np
+import os
+
+from io import StringIO
+from Uploads import SPOOL_DIR, file_digest, read_upload, to_columnar, read_columnar, preflight_upload
+from Matches import MATCH_COLUMNS, identify_new_matches, export_matches
 
 st.set_page_config(
     page_title='Identify New Live Alumni Matches',
@@ -59,17 +63,6 @@ def upload_data():
     return files
 
 
-def clean_linkedin(url):
-    if url.endswith('/'):
-        url = url[:-1]
-
-    return url.replace('https://www.', '').replace('http://www.', '').replace('www.', '')
-
-
-def format_import_id(import_id):
-    return str(import_id)[0:5] + '-' + str(import_id)[5:8] + '-' + str(import_id)[-10:]
-
-
 @st.cache_data
 def load_data(csv_file):
     df = pd.read_csv(csv_file)
@@ -93,82 +86,54 @@ if uploaded_file:
     if set(mandatory_files).issubset(set(uploaded_file_names)):
         st.success("All mandatory files are present.")
 
-        if st.button(label='Process Data', type='primary', use_container_width=True):
+        # Wrong columns or encodings are reported before any file is read in full
+        errors = []
+
+        for file in uploaded_file:
+            try:
+                preflight_upload(file)
+
+            except ValueError as e:
+                errors.append(str(e))
+
+        for error in errors:
+            st.error(error)
+
+        if not errors and st.button(label='Process Data', type='primary', use_container_width=True):
             for file in uploaded_file:
+                # Only the columns used for matching are read from the columnar copy of the uploads. Each is kept in a
+                # store named after its content, so that it is converted once whoever uploads it, and never replaced
+                # by another user's file.
+                store_dir = os.path.join(SPOOL_DIR, 'Matches', file_digest(file))
+
                 if file.name == 'Live Alumni.csv':
-                    live_alumni = pd.read_csv(file, low_memory=False)
+                    live_alumni = read_columnar(to_columnar(file, store_dir=store_dir),
+                                                columns=MATCH_COLUMNS[file.name], store_dir=store_dir)
 
                 elif file.name == 'Custom Fields.csv':
-                    custom_fields = pd.read_csv(file, encoding='latin1', low_memory=False)
+                    custom_fields = read_columnar(to_columnar(file, store_dir=store_dir),
+                                                  columns=MATCH_COLUMNS[file.name], store_dir=store_dir)
 
                 elif file.name == 'Phone List.csv':
-                    phones = pd.read_csv(file, encoding='latin1', low_memory=False)
+                    phones = read_columnar(to_columnar(file, store_dir=store_dir),
+                                           columns=MATCH_COLUMNS[file.name], store_dir=store_dir)
 
                 if file.name == 'Matches.csv':
-                    manual = pd.read_csv(file, low_memory=False)
+                    manual = read_upload(file)
 
                 else:
                     manual = pd.DataFrame()
 
-            custom_fields_1 = custom_fields[custom_fields['CAttrCat'] == 'Live Alumni ID'][
-                ['ConsID', 'CAttrDesc']].copy()
-
-            live_alumni_1 = live_alumni.melt(
-                id_vars='personid',
-                value_name='ConsID',
-                var_name='Type',
-                value_vars=['Person Constituent ID', 'Person Level 1 Constituent ID', 'Person Level 2 Constituent ID']
-            ).drop_duplicates(subset=['personid']).dropna().drop(columns='Type').sort_values(by=['ConsID'])
-
-            new_matches_1 = live_alumni_1[
-                ~(live_alumni_1['ConsID'].astype(int).isin(custom_fields_1['ConsID'].astype(int))) &
-                ~(live_alumni_1['personid'].astype(int).isin(custom_fields_1['CAttrDesc'].astype(int)))
-                ]
-
-            phones = phones[
-                (phones['PhoneType'].str.lower().str.contains('linkedin')) &
-                (phones['PhoneIsInactive'] is False)
-                ][['ConsID', 'PhoneNum']]
-
-            phones['PhoneNum'] = phones['PhoneNum'].apply(lambda x: clean_linkedin(x))
-
-            live_alumni_2 = live_alumni[['personid', 'Person URL']].drop_duplicates().copy()
-
-            live_alumni_2['Person URL'] = live_alumni_2['Person URL'].apply(lambda x: clean_linkedin(x))
-
-            new_matches_2 = live_alumni_2[
-                (live_alumni_2['Person URL'].isin(phones['PhoneNum'])) &
-                ~(live_alumni_2['personid'].astype(int).isin(custom_fields_1['CAttrDesc'].astype(int)))
-                ].copy()
-
-            new_matches_2 = new_matches_2.merge(phones, left_on='Person URL', right_on='PhoneNum', how='left')[
-                ['personid', 'ConsID']]
-
-            new_matches = pd.concat([new_matches_1, new_matches_2, manual], axis=0, ignore_index=True)
-
-            new_matches.drop_duplicates(inplace=True)
-
-            max_id = custom_fields['CAttrImpID'].replace('[^0-9]', '', regex=True).astype(int).sort_values(
-                ascending=False)[0] + 9999999999
-
-            new_matches_data = pd.DataFrame(data={
-                'CAttrImpID': np.arange(max_id, max_id + new_matches.shape[0]),
-                'CAttrCat': 'Live Alumni ID',
-                'CAttrCom': np.NaN,
-                'ConsID': new_matches['ConsID'].astype(int).values,
-                'CAttrDate': pd.to_datetime('today').strftime('%d-%b-%Y'),
-                'CAttrDesc': new_matches['personid'].values
-            })
-
-            new_matches_data['CAttrImpID'] = new_matches_data['CAttrImpID'].apply(lambda x: format_import_id(x))
-
-            new_matches_data.to_csv('Final/New Live Alumni Matches.csv', quoting=1, lineterminator='\r\n',
-                                    index=False)
+            new_matches_data = identify_new_matches(live_alumni, custom_fields, phones, manual)
 
             if new_matches_data.shape[0] > 0:
+                # Only offered as a download, as nothing else on the server reads it
+                buffer = StringIO()
+                export_matches(new_matches_data, buffer)
+
                 st.download_button(
                     label='Download New Live Alumni Matches',
-                    data=new_matches_data.to_csv(quoting=1, lineterminator='\r\n', index=False).encode('utf-8'),
+                    data=buffer.getvalue().encode('utf-8'),
                     file_name='New Live Alumni Matches.csv',
                     mime='text/csv',
                     use_container_width=True
@@ -1,33 +1,21 @@
 import streamlit as st
 import pandas as pd
 import os
-import re
-import psycopg2
-import subprocess
-import sys
-import zipfile
-import shutil
+import json
+import time
 
-from psycopg2 import sql
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
-from urllib.parse import quote_plus
-from sqlalchemy import create_engine
-from io import BytesIO
+from Uploads import RejectLog, table_name, to_columnar, spool_upload, validate_upload, preflight_upload
+from Database import get_backend, connect_to_db, get_schema, get_store_dir, bulk_load, build_derived_tables
+from Workspaces import create_workspace, record_file_loaded, finish_load, get_loaded_workspaces, get_loads
+from StageCache import get_cache_size, purge_results
+from Metrics import inc, record_file_load
+from Jobs import submit_job, get_jobs, get_output_dir, read_log, zip_results
 
 
 ########################################################################################################################
 #                                                   Load Functions                                                     #
 ########################################################################################################################
 
-def get_env_variables():
-    return {
-        'DB_IP': os.getenv('DB_IP'),
-        'DB_USER': os.getenv('DB_USER'),
-        'DB_PASS': quote_plus(os.getenv('DB_PASS')),
-        'DB_NAME': os.getenv('DB_NAME')
-    }
-
-
 def upload_data():
     st.header('Upload Data', divider='blue')
 
@@ -48,7 +36,7 @@ def upload_data():
     return files
 
 
-# @st.cache_data
+@st.cache_data
 def load_data(csv_file):
     df = pd.read_csv(csv_file)
     return df
@@ -60,100 +48,248 @@ def load_to_db(files):
         st.info('Please stay on the page. Going back or navigating elsewhere would reset the request. Don\'t click any '
                 'button as well.')
 
-        initialize_db()
+        # A new workspace for every upload, leaving the data of other users and earlier uploads untouched
+        workspace = create_workspace()
+        rejects = RejectLog()
+
+        if get_backend() == 'postgres':
+            client = connect_to_db(workspace)
 
         for each_file in files:
-            df = pd.read_csv(each_file, encoding='latin1', low_memory=False)
+            # Loaders read the spooled copy from disk, a block at a time
+            path, digest = spool_upload(each_file)
+            start = time.perf_counter()
+
+            try:
+                rows = validate_upload(path, each_file.name)
+
+                # The embedded backend queries the columnar copy of the uploads directly
+                if get_backend() == 'duckdb':
+                    to_columnar(path, file_name=each_file.name, store_dir=get_store_dir(workspace), digest=digest,
+                                rejects=rejects)
+
+                else:
+                    bulk_load(client, path, each_file.name, table_name(each_file.name), get_schema(workspace),
+                              rejects)
+
+            except ValueError as e:
+                inc('live_alumni_file_loads_total', file=each_file.name, status='failed')
+                st.error(e)
+                return
+
+            finally:
+                os.remove(path)
+
+            record_file_load(each_file.name, each_file.size, rows, time.perf_counter() - start)
+            record_file_loaded(workspace, each_file.name, digest, rows, rejects.rejected_rows(each_file.name))
 
-            file_name = re.sub(
-                '[^a-zA-Z _]', '', each_file.name
-            ).replace('csv', '').strip().title().replace(' ', '_')
+        show_rejects(rejects)
 
-            df.to_sql(
-                name=file_name,
-                con=connect_to_db(),
-                if_exists='replace',
-                index=False
-            )
+        if get_backend() == 'duckdb':
+            build_derived_tables(connect_to_db(workspace), get_store_dir(workspace))
+            finish_load(workspace)
+
+            st.session_state['workspace'] = workspace
+
+            st.success('Data Uploaded!', icon='✅')
+            st.info('Kindly proceed to the Process..')
+
+            return
 
         # Upload Country Mapping
         country_mapping = load_data('Files/Country Mapping.csv')
 
         country_mapping.to_sql(
             name='Country_Mapping',
-            con=connect_to_db(),
+            con=client,
+            schema=get_schema(workspace),
             if_exists='replace',
             index=False
         )
 
+        build_derived_tables(client)
+        finish_load(workspace)
+
+        st.session_state['workspace'] = workspace
+
         st.success('Data Uploaded!', icon='✅')
         st.info('Kindly proceed to the Process..')
-        available_options.append('Process')
 
 
-def initialize_db():
-    # Create a connection object
-    conn = psycopg2.connect(
-        dbname=get_env_variables().get('DB_USER'),
-        user=get_env_variables().get('DB_USER'),
-        host=get_env_variables().get('DB_IP'),
-        password=get_env_variables().get('DB_PASS')
-    )
+# Check the header and first rows of every upload, which takes milliseconds, before any of them is loaded
+def preflight(files):
+    checks = []
+    errors = []
 
-    # Set the isolation level for the connection
-    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    for each_file in files:
+        try:
+            checks.append(preflight_upload(each_file))
 
-    # Create a cursor object
-    cur = conn.cursor()
+        except ValueError as e:
+            errors.append(str(e))
 
-    # Use the psycopg2.sql module to create the query
-    query = sql.SQL(
-        f"DROP DATABASE IF EXISTS {os.getenv('DB_NAME')};"
-    )
+    for error in errors:
+        st.error(error)
+
+    if checks:
+        st.dataframe(pd.DataFrame(checks), hide_index=True, use_container_width=True)
 
-    # Execute the query
-    cur.execute(query)
+    return not errors
 
-    query = sql.SQL(
-        f"CREATE DATABASE {os.getenv('DB_NAME')};"
+
+# Values that didn't fit the type of their column
+def show_rejects(rejects):
+    summary = rejects.summary()
+
+    if summary.empty:
+        return
+
+    st.warning('Some values could not be read. Rejected rows are not loaded, other values are left empty.')
+    st.dataframe(summary, hide_index=True, use_container_width=True)
+
+    with st.expander('Rejected values'):
+        report = rejects.report()
+        st.dataframe(report, hide_index=True, use_container_width=True)
+        st.download_button('Download the report', data=report.to_csv(index=False), file_name='Rejected Values.csv',
+                           mime='text/csv')
+
+
+# Loaded data to process, the one loaded in this session by default. Data loaded in earlier sessions, or before a
+# restart, can be processed again without uploading it.
+def select_workspace(workspaces):
+    options = list(workspaces['workspace_id'])
+    current = st.session_state.get('workspace')
+
+    details = workspaces.set_index('workspace_id')
+
+    workspace = st.selectbox(
+        'Loaded data',
+        options=options,
+        index=options.index(current) if current in options else 0,
+        format_func=lambda x: f"Loaded at {details.at[x, 'loaded_at']} ({details.at[x, 'files']} files, "
+                              f"{details.at[x, 'rows']:,} rows)"
     )
 
-    # Execute the query
-    cur.execute(query)
+    with st.expander('Loaded files'):
+        st.dataframe(get_loads(workspace), hide_index=True, use_container_width=True)
+
+    return workspace
+
+
+# Options of a processing run, passed to Processing.py as environment variables
+def get_job_options(profile_sql=False, profile_cpu=False, profile_memory=False, full_refresh=False, sample_size=0):
+    options = {}
+
+    if profile_sql:
+        options['PROFILE_SQL'] = 'true'
+
+    if profile_cpu:
+        options['PROFILE_CPU'] = 'true'
+
+    if profile_memory:
+        options['PROFILE_MEMORY'] = 'true'
+
+    if full_refresh:
+        options['FULL_REFRESH'] = 'true'
+
+    if sample_size:
+        options['SAMPLE_SIZE'] = str(sample_size)
+
+    return options
 
-    # Close the connection
-    conn.close()
 
+def show_run_metrics(output_dir):
+    report_file = os.path.join(output_dir, 'Run Metrics.json')
 
-def connect_to_db():
-    user = get_env_variables().get('DB_USER')
-    password = get_env_variables().get('DB_PASS')
-    db_ip = get_env_variables().get('DB_IP')
-    db = get_env_variables().get('DB_NAME')
+    if not os.path.exists(report_file):
+        return
 
-    return create_engine(f'postgresql+psycopg2://{user}:{password}@{db_ip}:5432/{db}', echo=False)
+    with open(report_file) as f:
+        report = json.load(f)
 
+    metrics = pd.DataFrame(report['stages'])
 
-# Function that runs the python script
-def run_script():
-    result = subprocess.run([sys.executable, 'Processing.py'], capture_output=True, text=True)
-    return result.stdout
+    if metrics.empty:
+        return
 
+    st.subheader('Run Metrics')
+    st.caption(f"Generated at {report['generated_at']}")
 
-def create_download_link():
-    # Create a BytesIO buffer
-    b = BytesIO()
+    st.dataframe(metrics, hide_index=True, use_container_width=True)
+    st.bar_chart(metrics, x='stage', y=['wall_time_s', 'cpu_time_s'], use_container_width=True)
 
-    with zipfile.ZipFile(b, 'w') as zip_files:
-        # Specify the directory of CSV files
-        directory = 'Final'
-        for filename in os.listdir(directory):
-            if filename.endswith('.csv'):
-                zip_files.write(os.path.join(directory, filename))
 
-    b.seek(0)
+def show_sql_profile(output_dir):
+    profile_file = os.path.join(output_dir, 'SQL Profile.json')
 
-    return b
+    if not os.path.exists(profile_file):
+        return
+
+    with open(profile_file) as f:
+        profile = json.load(f)
+
+    st.subheader('SQL Profile')
+    st.dataframe(pd.DataFrame(profile['queries']), hide_index=True, use_container_width=True)
+
+    for slow_query in profile['slow_queries']:
+        with st.expander(f"Slow query ({slow_query['duration_ms']} ms): {slow_query['query'][:100]}"):
+            st.code(slow_query['query'], language='sql')
+            st.code(slow_query.get('plan', ''), language='text')
+
+
+def show_cpu_profile(output_dir):
+    profile_file = os.path.join(output_dir, 'CPU Profile.json')
+
+    if not os.path.exists(profile_file):
+        return
+
+    with open(profile_file) as f:
+        profile = json.load(f)
+
+    st.subheader('CPU Profile')
+    st.caption(f"{profile['samples']} samples, one every {profile['interval_ms']} ms")
+    st.dataframe(pd.DataFrame(profile['hotspots']), hide_index=True, use_container_width=True)
+
+    col1, col2 = st.columns(2)
+
+    with col1:
+        with open(os.path.join(output_dir, 'CPU Profile.folded'), 'rb') as f:
+            st.download_button('Download the flame graph stacks', data=f.read(), file_name='CPU Profile.folded',
+                               mime='text/plain', use_container_width=True,
+                               help='Collapsed stacks, to open with speedscope or flamegraph.pl')
+
+    with col2:
+        with open(profile_file, 'rb') as f:
+            st.download_button('Download the hotspots', data=f.read(), file_name='CPU Profile.json',
+                               mime='application/json', use_container_width=True)
+
+
+# Refreshed on its own every few seconds, while the rest of the page stays as it is
+@st.fragment(run_every=5)
+def show_jobs():
+    jobs = get_jobs()
+
+    if jobs.empty:
+        st.info('No processing runs yet.')
+        return
+
+    st.dataframe(
+        jobs[['job_id', 'status', 'progress', 'created_at', 'started_at', 'finished_at']],
+        hide_index=True,
+        use_container_width=True,
+        column_config={
+            'progress': st.column_config.ProgressColumn('progress', min_value=0, max_value=1)
+        }
+    )
+
+    job_id = st.selectbox('Run', options=jobs['job_id'], key='job_id')
+
+    with st.container(height=600):
+        st.code(read_log(job_id), language='shellSession')
+
+    show_run_metrics(get_output_dir(job_id))
+    show_sql_profile(get_output_dir(job_id))
+    show_cpu_profile(get_output_dir(job_id))
 
 
 ########################################################################################################################
@@ -193,8 +329,6 @@ with st.sidebar:
 ########################################################################################################################
 #                                                  1 - Load Data                                                       #
 ########################################################################################################################
-uploaded = False
-
 if task == available_options[0]:
     # Upload files
     uploaded_files = upload_data()
@@ -211,13 +345,9 @@ if task == available_options[0]:
         if set(mandatory_files).issubset(set(uploaded_file_names)):
             st.success("All mandatory files are present.")
 
-            # Connect DB
-            client = connect_to_db()
-
-            # Load to DB
-            load_to_db(uploaded_files)
-
-            uploaded = True
+            # Load to DB, once every file passed the preflight checks
+            if preflight(uploaded_files):
+                load_to_db(uploaded_files)
 
         else:
             missing_files = set(mandatory_files) - set(uploaded_file_names)
@@ -226,41 +356,68 @@ if task == available_options[0]:
 ########################################################################################################################
 #                                                 2 - Process Data                                                     #
 ########################################################################################################################
-processed = False
-
 if task == available_options[1]:
     st.header('Process Data', divider='blue')
 
-    if uploaded is True:
-        st.subheader('')
+    loaded_workspaces = get_loaded_workspaces()
 
-        if st.button(label='Process Data', type='primary', use_container_width=True):
-            # Delete Previous files
-            shutil.rmtree('Final')
-            os.mkdir('Final')
+    if not loaded_workspaces.empty:
+        workspace = select_workspace(loaded_workspaces)
 
-            output = run_script()
+        st.subheader('')
 
-            with st.container(height=600):
-                st.code(output, language='shellSession')
+        profile_sql = st.checkbox('Profile SQL queries', help='Records every query and captures EXPLAIN plans for '
+                                                             'slow ones')
+        profile_cpu = st.checkbox('Profile CPU', help='Samples where the time of each stage goes, for a flame graph '
+                                                      'and a table of hotspots')
+        profile_memory = st.checkbox('Profile memory', help='Measures the peak memory of each stage, which slows the '
+                                                            'run down')
+        full_refresh = st.checkbox('Full refresh', help='Processes every alumni, instead of only the ones who changed '
+                                                        'since the last successful run, and recomputes every stage '
+                                                        'instead of reusing the ones completed by an earlier run')
+        sample_size = st.number_input('Sample size', min_value=0, value=0, step=100,
+                                      help='Processes only this many alumni, always the same ones, to check the '
+                                           'output quickly. 0 processes everyone.')
 
-            processed = True
+        if st.button(label='Process Data', type='primary', use_container_width=True):
+            job_id = submit_job(get_job_options(profile_sql, profile_cpu, profile_memory, full_refresh, sample_size),
+                                workspace)
+            st.success(f'Processing queued as run {job_id}. You can leave this page, the run carries on.')
 
     else:
         st.warning('Please Load data to process first!')
 
+    st.subheader('Processing Runs')
+    show_jobs()
+
+    # Stages whose inputs didn't change reuse their saved result, until it is evicted or removed here
+    with st.expander('Saved stage results'):
+        st.caption(f'{get_cache_size() / 1024 ** 2:.1f} MB of stage results are reused by runs whose inputs are '
+                   f'unchanged.')
+
+        if st.button('Remove saved stage results'):
+            purge_results()
+            st.success('Saved stage results removed. The next run recomputes every stage.')
+
 ########################################################################################################################
 #                                               3 - Download Data                                                      #
 ########################################################################################################################
 if task == available_options[2]:
     st.header('Download Processed Data', divider='blue')
 
-    if processed:
+    succeeded = get_jobs().query("status == 'succeeded'")
+
+    if not succeeded.empty:
         # Create a download button
         st.header('📥  Download Data to upload in Raisers Edge')
         st.subheader('')
 
-        buffer = create_download_link()
+        job_id = st.selectbox(
+            'Run', options=succeeded['job_id'],
+            format_func=lambda x: f"{x} ({succeeded.set_index('job_id').at[x, 'finished_at']})"
+        )
+
+        buffer = zip_results(job_id)
         st.download_button(
             label='DOWNLOAD',
             data=buffer,
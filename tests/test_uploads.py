@@ -0,0 +1,69 @@
+import csv
+import os
+import pytest
+
+import Uploads
+from Uploads import FILE_SCHEMAS, preflight_upload, validate_upload, to_columnar, read_manifest
+
+
+# Live Alumni export with the given headlines, one row each, written the way RE and Excel save it
+def write_live_alumni(path, headlines, encoding):
+    columns = list(FILE_SCHEMAS['Live Alumni.csv']) + ['Extra Col']
+
+    with open(path, 'w', encoding=encoding, newline='') as f:
+        writer = csv.writer(f, lineterminator='\r\n')
+        writer.writerow(columns)
+
+        for i, headline in enumerate(headlines):
+            row = dict.fromkeys(columns, '')
+            row.update({'personid': str(1000 + i), 'Person Headline': headline})
+            writer.writerow(row.values())
+
+    return path
+
+
+# \x85 is both the cp1252 ellipsis and the second byte of UTF-8 letters such as Å (C3 85), neither of which ends a line
+@pytest.mark.parametrize('headline, encoding', [('Consultant in Åland', 'utf-8'), ('Director… of Sales', 'cp1252')])
+def test_preflight_keeps_rows_with_x85(tmp_path, headline, encoding):
+    path = write_live_alumni(tmp_path / 'Live Alumni.csv', ['Analyst', headline, 'Manager'], encoding)
+
+    check = preflight_upload(str(path))
+
+    assert check['columns'] == len(FILE_SCHEMAS['Live Alumni.csv']) + 1
+    assert check['estimated_rows'] == validate_upload(path, 'Live Alumni.csv') == 3
+
+
+def test_preflight_rejects_short_rows(tmp_path):
+    path = write_live_alumni(tmp_path / 'Live Alumni.csv', ['Analyst'], 'utf-8')
+
+    with open(path, 'a', newline='') as f:
+        f.write('1001,short\r\n')
+
+    with pytest.raises(ValueError, match='at lines 3'):
+        preflight_upload(str(path))
+
+
+# Files without a sidecar are reused whatever EXTRA_COLUMNS is, and Live Alumni as long as it doesn't change
+def test_columnar_copies_are_reused_with_sidecars(tmp_path, monkeypatch):
+    monkeypatch.setattr(Uploads, 'EXTRA_COLUMNS', 'sidecar')
+
+    live_alumni = write_live_alumni(tmp_path / 'Live Alumni.csv', ['Analyst', 'Manager'], 'utf-8')
+    custom_fields = tmp_path / 'Custom Fields.csv'
+    custom_fields.write_text('CAttrImpID,CAttrCat,CAttrCom,ConsID,CAttrDate,CAttrDesc\r\n'
+                             '00001-083-0000000001,Live Alumni ID,,1,01-Jan-2024,1000\r\n')
+
+    store_dir = tmp_path / 'Store'
+
+    def convert():
+        for path in [live_alumni, custom_fields]:
+            to_columnar(str(path), store_dir=str(store_dir))
+
+        return {
+            entry.name: entry.stat().st_mtime_ns for entry in os.scandir(store_dir) if entry.name.endswith('.arrow')
+        }
+
+    first = convert()
+
+    assert sorted(first) == ['Custom_Fields.arrow', 'Live_Alumni.arrow', 'Live_Alumni_Extra.arrow']
+    assert read_manifest(str(store_dir))['Custom_Fields']['extra_columns'] == 'skip'
+    assert convert() == first
@@ -1,5 +1,8 @@
 import streamlit as st
 
+# Serves the metrics endpoint, whichever page is opened first
+import Metrics
+
 ########################################################################################################################
 # Streamlit Defaults
 ########################################################################################################################